@@ -1,8 +1,485 @@
 from database import db
-from typing import Optional, List, Dict, Any
-from datetime import datetime, timedelta, date
+from typing import Optional, List, Dict, Any, Callable, Iterator
+from datetime import datetime
 from decimal import Decimal
-from schema.schema_context import has_schema
+from dataclasses import dataclass
+import copy
+import functools
+import logging
+import threading
+import orjson
+from cachetools import TTLCache
+from schema.schema_context import has_schema, get_current_schema
+
+logger = logging.getLogger(__name__)
+
+
+def _json_default(value: Any) -> Any:
+    """Convert các kiểu SQL mà orjson không tự serialize được"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='ignore')
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def _jsonify(data: Any) -> bytes:
+    """
+    Serialize kết quả API thành JSON bytes
+    
+    orjson tự xử lý datetime/date (isoformat), Decimal/bytes đi qua _json_default
+    """
+    return orjson.dumps(data, default=_json_default)
+
+
+def to_jsonable(data: Any) -> Any:
+    """
+    Convert kết quả API (còn kiểu dữ liệu SQL) thành dict/list JSON thuần
+    
+    Chỉ gọi khi thật sự cần dict thuần (ví dụ: gửi function response cho Gemini)
+    """
+    return orjson.loads(_jsonify(data))
+
+
+# Cache cho các bảng danh mục ít thay đổi (service types, categories, floors...)
+# Mỗi function được cache có TTLCache riêng, key gồm schema nên không lẫn dữ liệu giữa các toà nhà
+_CATALOG_CACHES: List[TTLCache] = []
+_CATALOG_CACHE_LOCK = threading.RLock()
+
+
+def _cached(ttl: int = 300, maxsize: int = 512) -> Callable:
+    """
+    Decorator cache kết quả thành công của API theo (schema, function, args) trong ttl giây
+    
+    Trả về bản deepcopy để caller sửa kết quả không làm hỏng cache
+    """
+    def decorator(fn: Callable) -> Callable:
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        _CATALOG_CACHES.append(cache)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            schema = get_current_schema()
+            if schema is None:
+                return fn(*args, **kwargs)
+
+            key = (schema, fn.__name__, args, tuple(sorted(kwargs.items())))
+            with _CATALOG_CACHE_LOCK:
+                result = cache.get(key)
+
+            if result is None:
+                result = fn(*args, **kwargs)
+                # Không cache lỗi
+                if not result.get("success"):
+                    return result
+                with _CATALOG_CACHE_LOCK:
+                    cache[key] = result
+
+            return copy.deepcopy(result)
+
+        return wrapper
+    return decorator
+
+
+def clear_catalog_cache(schema: Optional[str] = None) -> None:
+    """
+    Xóa cache danh mục (ví dụ: sau khi cập nhật bảng giá)
+    
+    Args:
+        schema: Chỉ xóa cache của toà nhà này; None → xóa toàn bộ
+    """
+    with _CATALOG_CACHE_LOCK:
+        for cache in _CATALOG_CACHES:
+            if schema is None:
+                cache.clear()
+                continue
+            for key in [key for key in cache.keys() if key[0] == schema]:
+                cache.pop(key, None)
+
+
+# ==================== SQL ====================
+
+# Toàn bộ SQL được dựng 1 lần lúc import; {schema} được thay theo từng building
+# trong db (_render_query có LRU cache theo (query, schema)) nên mỗi call site
+# không phải build lại chuỗi query
+#
+# Các query batch (_Q_SERVICE_FEES, _Q_AMENITY_PACKAGE_PRICES) dùng OPENJSON:
+# database phải ở compatibility level >= 130 (SQL Server 2016+)
+
+_OPENJSON_HINT = (
+    "OPENJSON cần database ở compatibility level >= 130 (SQL Server 2016+), "
+    "kiểm tra: SELECT compatibility_level FROM sys.databases WHERE name = DB_NAME()"
+)
+
+
+def _db_error_message(e: Exception) -> str:
+    """Thông báo lỗi của query batch, kèm hướng dẫn khi lỗi do database chưa hỗ trợ OPENJSON"""
+    message = str(e)
+    if "OPENJSON" in message.upper():
+        return f"{message} ({_OPENJSON_HINT})"
+    return message
+
+# Cột trả về khi summary=True (đủ cho chatbot) và khi lấy đầy đủ
+_APARTMENT_SUMMARY_COLS = (
+    "a.apartment_id",
+    "f.floor_number",
+    "a.number as apartment_number",
+    "a.area_m2",
+    "a.bedrooms",
+    "a.status",
+    "a.type"
+)
+_APARTMENT_FULL_COLS = _APARTMENT_SUMMARY_COLS + (
+    "a.floor_id",
+    "f.name as floor_name",
+    "a.created_at",
+    "a.updated_at"
+)
+_AMENITY_SUMMARY_COLS = (
+    "a.amenity_id",
+    "a.code",
+    "a.name",
+    "a.category_name",
+    "a.location",
+    "a.has_monthly_package",
+    "a.fee_type",
+    "a.status"
+)
+_AMENITY_FULL_COLS = _AMENITY_SUMMARY_COLS + (
+    "a.requires_face_verification",
+    "a.asset_id"
+)
+
+_Q_SERVICE_TYPES = """
+    SELECT 
+        st.service_type_id,
+        st.code,
+        st.name,
+        st.unit,
+        st.is_mandatory,
+        st.is_recurring,
+        st.is_active,
+        c.name as category_name
+    FROM {schema}.service_types st
+    LEFT JOIN {schema}.service_type_categories c ON st.category_id = c.category_id
+    WHERE st.is_active = 1 AND st.is_delete = 0
+        AND (? IS NULL OR c.name = ?)
+    ORDER BY st.name
+"""
+
+_Q_SERVICE_PRICES = """
+    SELECT 
+        st.code as service_code,
+        st.name as service_name,
+        st.unit,
+        sp.unit_price,
+        sp.effective_date,
+        sp.end_date,
+        sp.status
+    FROM {schema}.service_prices sp
+    INNER JOIN {schema}.service_types st ON sp.service_type_id = st.service_type_id
+    WHERE (? IS NULL OR st.code = ?)
+        AND (? = 0 OR (
+            sp.status = 'APPROVED'
+            AND sp.effective_date <= GETDATE()
+            AND (sp.end_date IS NULL OR sp.end_date >= GETDATE())
+        ))
+    ORDER BY st.name, sp.effective_date DESC
+"""
+
+# Lấy giá hiện tại
+# "Hiện tại" = GETDATE() của DB server (cùng giờ địa phương với effective_date/end_date),
+# không lấy giờ của container app (UTC) để khung hiệu lực giá không bị lệch
+_Q_SERVICE_FEE = """
+    SELECT TOP 1
+        st.code,
+        st.name,
+        st.unit,
+        sp.unit_price
+    FROM {schema}.service_prices sp
+    INNER JOIN {schema}.service_types st ON sp.service_type_id = st.service_type_id
+    WHERE st.code = ?
+        AND sp.status = 'APPROVED'
+        AND sp.effective_date <= GETDATE()
+        AND (sp.end_date IS NULL OR sp.end_date >= GETDATE())
+    ORDER BY sp.effective_date DESC
+"""
+
+# Lấy giá hiện tại (mới nhất) của tất cả mã dịch vụ trong 1 query
+# Danh sách mã truyền vào 1 tham số JSON (OPENJSON) để SQL text luôn cố định
+_Q_SERVICE_FEES = """
+    SELECT code, name, unit, unit_price
+    FROM (
+        SELECT
+            st.code,
+            st.name,
+            st.unit,
+            sp.unit_price,
+            ROW_NUMBER() OVER (
+                PARTITION BY st.code
+                ORDER BY sp.effective_date DESC
+            ) as price_rank
+        FROM {schema}.service_prices sp
+        INNER JOIN {schema}.service_types st ON sp.service_type_id = st.service_type_id
+        INNER JOIN OPENJSON(?) WITH (code NVARCHAR(100) '$') requested ON requested.code = st.code
+        WHERE sp.status = 'APPROVED'
+            AND sp.effective_date <= GETDATE()
+            AND (sp.end_date IS NULL OR sp.end_date >= GETDATE())
+    ) prices
+    WHERE price_rank = 1
+"""
+
+_Q_SERVICE_CATEGORIES = """
+    SELECT 
+        category_id,
+        name,
+        description
+    FROM {schema}.service_type_categories
+    ORDER BY name
+"""
+
+# Lấy gói rẻ nhất và tổng số gói ACTIVE của mỗi tiện ích trong cùng 1 query
+_Q_AMENITIES = """
+    SELECT
+        {columns},
+        pkg.package_name as cheapest_package_name,
+        pkg.month_count as cheapest_month_count,
+        pkg.price as cheapest_price,
+        pkg.total_packages
+    FROM {schema}.amenities a
+    LEFT JOIN (
+        SELECT
+            amenity_id,
+            name as package_name,
+            month_count,
+            price,
+            ROW_NUMBER() OVER (
+                PARTITION BY amenity_id
+                ORDER BY CASE WHEN price IS NULL THEN 1 ELSE 0 END, price
+            ) as price_rank,
+            COUNT(*) OVER (PARTITION BY amenity_id) as total_packages
+        FROM {schema}.amenity_packages
+        WHERE status = 'ACTIVE'
+    ) pkg ON pkg.amenity_id = a.amenity_id
+        AND pkg.price_rank = 1
+        AND a.has_monthly_package = 1
+    WHERE a.is_delete = 0
+        AND (? IS NULL OR a.category_name = ?)
+        AND (? IS NULL OR a.status = ?)
+        AND (? IS NULL OR a.has_monthly_package = ?)
+    ORDER BY a.category_name, a.name
+"""
+_Q_AMENITIES_SUMMARY = _Q_AMENITIES.replace("{columns}", ", ".join(_AMENITY_SUMMARY_COLS))
+_Q_AMENITIES_FULL = _Q_AMENITIES.replace("{columns}", ", ".join(_AMENITY_FULL_COLS))
+
+# Lấy tiện ích và các gói ACTIVE của tiện ích trong cùng 1 query
+_Q_AMENITY_BY_CODE = """
+    SELECT
+        a.amenity_id,
+        a.code,
+        a.name,
+        a.category_name,
+        a.location,
+        a.has_monthly_package,
+        a.fee_type,
+        a.status,
+        a.requires_face_verification,
+        a.asset_id,
+        ap.package_id,
+        ap.name as package_name,
+        ap.month_count,
+        ap.price,
+        ap.description,
+        ap.status as package_status,
+        ap.duration_days,
+        ap.period_unit
+    FROM {schema}.amenities a
+    LEFT JOIN {schema}.amenity_packages ap ON ap.amenity_id = a.amenity_id
+        AND ap.status = 'ACTIVE'
+        AND a.has_monthly_package = 1
+    WHERE a.code = ? AND a.is_delete = 0
+    ORDER BY a.amenity_id, ap.month_count
+"""
+
+_Q_AMENITY_PACKAGES = """
+    SELECT
+        ap.package_id,
+        ap.amenity_id,
+        a.code as amenity_code,
+        a.name as amenity_name,
+        ap.name as package_name,
+        ap.month_count,
+        ap.price,
+        ap.description,
+        ap.status,
+        ap.duration_days,
+        ap.period_unit
+    FROM {schema}.amenity_packages ap
+    INNER JOIN {schema}.amenities a ON ap.amenity_id = a.amenity_id
+    WHERE (? IS NULL OR a.code = ?)
+        AND (? IS NULL OR ap.status = ?)
+    ORDER BY a.name, ap.month_count
+"""
+
+_Q_AMENITY_PACKAGE_PRICE = """
+    SELECT TOP 1
+        a.code,
+        a.name as amenity_name,
+        ap.name as package_name,
+        ap.month_count,
+        ap.price,
+        ap.duration_days,
+        ap.period_unit
+    FROM {schema}.amenity_packages ap
+    INNER JOIN {schema}.amenities a ON ap.amenity_id = a.amenity_id
+    WHERE a.code = ?
+        AND ap.month_count = ?
+        AND ap.status = 'ACTIVE'
+    ORDER BY ap.price ASC
+"""
+
+# Gói rẻ nhất cho mỗi (tiện ích, số tháng) của tất cả tiện ích trong 1 query
+# Danh sách mã truyền vào 1 tham số JSON (OPENJSON) để SQL text luôn cố định
+_Q_AMENITY_PACKAGE_PRICES = """
+    SELECT code, amenity_name, package_name, month_count, price, duration_days, period_unit
+    FROM (
+        SELECT
+            a.code,
+            a.name as amenity_name,
+            ap.name as package_name,
+            ap.month_count,
+            ap.price,
+            ap.duration_days,
+            ap.period_unit,
+            ROW_NUMBER() OVER (
+                PARTITION BY a.code, ap.month_count
+                ORDER BY ap.price ASC
+            ) as price_rank
+        FROM {schema}.amenity_packages ap
+        INNER JOIN {schema}.amenities a ON ap.amenity_id = a.amenity_id
+        INNER JOIN OPENJSON(?) WITH (code NVARCHAR(100) '$') requested ON requested.code = a.code
+        WHERE ap.status = 'ACTIVE'
+    ) packages
+    WHERE price_rank = 1
+"""
+
+_Q_FLOORS = """
+    SELECT
+        floor_id,
+        floor_number,
+        name
+    FROM {schema}.floors
+    ORDER BY floor_number
+"""
+
+_Q_APARTMENTS = """
+    SELECT
+        {columns}
+    FROM {schema}.apartments a
+    INNER JOIN {schema}.floors f ON a.floor_id = f.floor_id
+    WHERE (? IS NULL OR f.floor_number = ?)
+        AND (? IS NULL OR a.status = ?)
+        AND (? IS NULL OR a.type = ?)
+        AND (? IS NULL OR a.bedrooms >= ?)
+        AND (? IS NULL OR a.bedrooms <= ?)
+        AND (? IS NULL OR a.area_m2 >= ?)
+        AND (? IS NULL OR a.area_m2 <= ?)
+    ORDER BY f.floor_number, a.number
+"""
+_Q_APARTMENTS_SUMMARY = _Q_APARTMENTS.replace("{columns}", ", ".join(_APARTMENT_SUMMARY_COLS))
+_Q_APARTMENTS_FULL = _Q_APARTMENTS.replace("{columns}", ", ".join(_APARTMENT_FULL_COLS))
+
+_Q_APARTMENT_BY_NUMBER = """
+    SELECT
+        a.apartment_id,
+        a.floor_id,
+        f.floor_number,
+        f.name as floor_name,
+        a.number as apartment_number,
+        a.area_m2,
+        a.bedrooms,
+        a.status,
+        a.type,
+        a.image,
+        a.created_at,
+        a.updated_at
+    FROM {schema}.apartments a
+    INNER JOIN {schema}.floors f ON a.floor_id = f.floor_id
+    WHERE a.number = ?
+"""
+
+_Q_AVAILABLE_APARTMENTS = f"""
+    SELECT
+        {", ".join(_APARTMENT_FULL_COLS)}
+    FROM {{schema}}.apartments a
+    INNER JOIN {{schema}}.floors f ON a.floor_id = f.floor_id
+    WHERE a.status = 'AVAILABLE'
+        AND (? IS NULL OR a.type = ?)
+        AND (? IS NULL OR a.bedrooms >= ?)
+    ORDER BY f.floor_number, a.number
+"""
+
+# 1 lần scan: mỗi status 1 dòng + 1 dòng tổng (GROUPING(status) = 1)
+# AVG tính ở Python từ SUM/COUNT để không phải CAST area_m2 từng dòng
+_Q_APARTMENT_STATISTICS = """
+    SELECT
+        status,
+        GROUPING(status) as is_total,
+        COUNT(*) as apartment_count,
+        SUM(area_m2) as total_area,
+        COUNT(area_m2) as area_count,
+        MIN(area_m2) as min_area,
+        MAX(area_m2) as max_area
+    FROM {schema}.apartments
+    GROUP BY GROUPING SETS ((status), ())
+"""
+
+
+# Các cột thông tin tiện ích (dùng khi gom kết quả JOIN amenities + amenity_packages)
+_AMENITY_COLUMNS = (
+    'amenity_id',
+    'code',
+    'name',
+    'category_name',
+    'location',
+    'has_monthly_package',
+    'fee_type',
+    'status',
+    'requires_face_verification',
+    'asset_id'
+)
+
+
+@dataclass(slots=True, frozen=True)
+class ApartmentRow:
+    """
+    1 row căn hộ (thứ tự field = thứ tự cột _APARTMENT_SUMMARY_COLS)
+    
+    Nhẹ hơn dict (không có hash table mỗi row), orjson serialize dataclass trực tiếp
+    """
+    apartment_id: int
+    floor_number: int
+    apartment_number: str
+    area_m2: Decimal
+    bedrooms: int
+    status: str
+    type: str
+
+
+@dataclass(slots=True, frozen=True)
+class ApartmentDetailRow(ApartmentRow):
+    """Row căn hộ đầy đủ (thứ tự field = _APARTMENT_FULL_COLS)"""
+    floor_id: int
+    floor_name: str
+    created_at: datetime
+    updated_at: Optional[datetime]
+
+
+# Format tiền VND (bind sẵn 1 lần thay vì f-string cho từng dòng)
+_FMT_VND = "{:,.0f} VND".format
+
+# Response trả về khi chưa đăng nhập (dùng chung, không build lại mỗi lần gọi)
+_AUTH_ERROR_MESSAGE = "Authentication required. Please login to access this data."
 
 class ApartmentAPI:
     """API endpoints để truy vấn dữ liệu apartment management system"""
@@ -12,45 +489,24 @@ class ApartmentAPI:
         """
         Check xem có schema (đã đăng nhập) chưa
         
+        has_schema() chỉ là một lần đọc ContextVar nên không cần cache thêm
+        
         Returns:
             None nếu đã authenticated, dict error nếu chưa
         """
-        if not has_schema():
-            return {
-                "success": False,
-                "error": "Authentication required. Please login to access this data.",
-                "data": [],
-                "count": 0
-            }
-        return None
-    
-    @staticmethod
-    def _convert_to_serializable(data: Any) -> Any:
-        """
-        Convert SQL data types to JSON-serializable types
-        
-        Args:
-            data: Dữ liệu cần convert (có thể là dict, list, hoặc primitive)
-        
-        Returns:
-            Dữ liệu đã được convert
-        """
-        if isinstance(data, dict):
-            return {key: ApartmentAPI._convert_to_serializable(value) for key, value in data.items()}
-        elif isinstance(data, list):
-            return [ApartmentAPI._convert_to_serializable(item) for item in data]
-        elif isinstance(data, Decimal):
-            return float(data)
-        elif isinstance(data, (datetime, date)):
-            return data.isoformat()
-        elif isinstance(data, bytes):
-            return data.decode('utf-8', errors='ignore')
-        else:
-            return data
+        if has_schema():
+            return None
+        return {
+            "success": False,
+            "error": _AUTH_ERROR_MESSAGE,
+            "data": [],
+            "count": 0
+        }
     
     # ==================== SERVICE FEES FUNCTIONS ====================
     
     @staticmethod
+    @_cached(ttl=300)
     def get_service_types(category: Optional[str] = None) -> Dict[str, Any]:
         """
         Lấy danh sách loại dịch vụ
@@ -66,33 +522,10 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT 
-            st.service_type_id,
-            st.code,
-            st.name,
-            st.unit,
-            st.is_mandatory,
-            st.is_recurring,
-            st.is_active,
-            c.name as category_name
-        FROM {schema}.service_types st
-        LEFT JOIN {schema}.service_type_categories c ON st.category_id = c.category_id
-        WHERE st.is_active = 1 AND st.is_delete = 0
-        """
-        params = []
-        
-        if category:
-            query += " AND c.name = ?"
-            params.append(category)
-        
-        query += " ORDER BY st.name"
+        category = category or None
         
         try:
-            results = db.execute_query(query, tuple(params) if params else None)
-            
-            # Convert tất cả data types
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(_Q_SERVICE_TYPES, (category, category))
             
             return {
                 "success": True,
@@ -100,7 +533,7 @@ class ApartmentAPI:
                 "count": len(results)
             }
         except Exception as e:
-            print(f"❌ Error in get_service_types: {e}")
+            logger.exception("Error in get_service_types")
             return {
                 "success": False,
                 "error": str(e),
@@ -109,9 +542,11 @@ class ApartmentAPI:
             }
     
     @staticmethod
+    @_cached(ttl=300)
     def get_service_prices(
         service_type_code: Optional[str] = None,
-        active_only: bool = True
+        active_only: bool = True,
+        include_formatted: bool = False
     ) -> Dict[str, Any]:
         """
         Lấy giá dịch vụ hiện tại
@@ -119,6 +554,7 @@ class ApartmentAPI:
         Args:
             service_type_code: Mã loại dịch vụ (MGMT_FEE, PARKING_CAR, INTERNET...)
             active_only: Chỉ lấy giá đang áp dụng
+            include_formatted: Thêm unit_price_formatted ("100,000 VND") cho mỗi dòng
         
         Returns:
             Dict với data và count
@@ -128,42 +564,17 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT 
-            st.code as service_code,
-            st.name as service_name,
-            st.unit,
-            sp.unit_price,
-            sp.effective_date,
-            sp.end_date,
-            sp.status
-        FROM {schema}.service_prices sp
-        INNER JOIN {schema}.service_types st ON sp.service_type_id = st.service_type_id
-        WHERE 1=1
-        """
-        params = []
-        
-        if service_type_code:
-            query += " AND st.code = ?"
-            params.append(service_type_code)
-        
-        if active_only:
-            query += " AND sp.status = 'APPROVED'"
-            query += " AND sp.effective_date <= GETDATE()"
-            query += " AND (sp.end_date IS NULL OR sp.end_date >= GETDATE())"
-        
-        query += " ORDER BY st.name, sp.effective_date DESC"
+        service_type_code = service_type_code or None
+        params = (service_type_code, service_type_code, 1 if active_only else 0)
         
         try:
-            results = db.execute_query(query, tuple(params) if params else None)
+            results = db.execute_query(_Q_SERVICE_PRICES, params)
             
-            # Convert tất cả data types
-            results = ApartmentAPI._convert_to_serializable(results)
-            
-            # Format giá tiền
-            for row in results:
-                if 'unit_price' in row and row['unit_price']:
-                    row['unit_price_formatted'] = f"{row['unit_price']:,.0f} VND"
+            # Format giá tiền (chatbot tự format nên mặc định bỏ qua)
+            if include_formatted:
+                for row in results:
+                    if row['unit_price']:
+                        row['unit_price_formatted'] = _FMT_VND(row['unit_price'])
             
             return {
                 "success": True,
@@ -171,7 +582,7 @@ class ApartmentAPI:
                 "count": len(results)
             }
         except Exception as e:
-            print(f"❌ Error in get_service_prices: {e}")
+            logger.exception("Error in get_service_prices")
             return {
                 "success": False,
                 "error": str(e),
@@ -182,7 +593,8 @@ class ApartmentAPI:
     @staticmethod
     def calculate_service_fee(
         service_code: str,
-        quantity: float = 1.0
+        quantity: float = 1.0,
+        include_formatted: bool = False
     ) -> Dict[str, Any]:
         """
         Tính phí dịch vụ
@@ -190,6 +602,7 @@ class ApartmentAPI:
         Args:
             service_code: Mã dịch vụ (MGMT_FEE, PARKING_CAR...)
             quantity: Số lượng (diện tích, số tháng...)
+            include_formatted: Thêm các field *_formatted ("100,000 VND")
         
         Returns:
             Dict với thông tin tính toán
@@ -199,45 +612,31 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        # Lấy giá hiện tại
-        query = """
-        SELECT TOP 1
-            st.code,
-            st.name,
-            st.unit,
-            sp.unit_price
-        FROM {schema}.service_prices sp
-        INNER JOIN {schema}.service_types st ON sp.service_type_id = st.service_type_id
-        WHERE st.code = ?
-            AND sp.status = 'APPROVED'
-            AND sp.effective_date <= GETDATE()
-            AND (sp.end_date IS NULL OR sp.end_date >= GETDATE())
-        ORDER BY sp.effective_date DESC
-        """
         
         try:
-            results = db.execute_query(query, (service_code,))
+            results = db.execute_query(_Q_SERVICE_FEE, (service_code,))
             
             if results:
-                # Convert data types
-                results = ApartmentAPI._convert_to_serializable(results)
                 service = results[0]
                 
                 unit_price = float(service['unit_price'])
                 total = unit_price * quantity
                 
+                fee = {
+                    "service_code": service['code'],
+                    "service_name": service['name'],
+                    "unit": service['unit'],
+                    "unit_price": unit_price,
+                    "quantity": quantity,
+                    "total": total
+                }
+                if include_formatted:
+                    fee["unit_price_formatted"] = _FMT_VND(unit_price)
+                    fee["total_formatted"] = _FMT_VND(total)
+                
                 return {
                     "success": True,
-                    "data": {
-                        "service_code": service['code'],
-                        "service_name": service['name'],
-                        "unit": service['unit'],
-                        "unit_price": unit_price,
-                        "unit_price_formatted": f"{unit_price:,.0f} VND",
-                        "quantity": quantity,
-                        "total": total,
-                        "total_formatted": f"{total:,.0f} VND"
-                    }
+                    "data": fee
                 }
             else:
                 return {
@@ -245,13 +644,107 @@ class ApartmentAPI:
                     "error": f"Không tìm thấy dịch vụ với mã: {service_code}"
                 }
         except Exception as e:
-            print(f"❌ Error in calculate_service_fee: {e}")
+            logger.exception("Error in calculate_service_fee")
             return {
                 "success": False,
                 "error": str(e)
             }
     
     @staticmethod
+    def calculate_service_fees(
+        items: List[Dict[str, Any]],
+        include_formatted: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Tính phí cho nhiều dịch vụ cùng lúc (1 query cho tất cả mã dịch vụ)
+        
+        Args:
+            items: Danh sách {"service_code": str, "quantity": float}
+            include_formatted: Thêm các field *_formatted ("100,000 VND")
+        
+        Returns:
+            Dict với chi tiết từng dịch vụ và tổng cộng
+        """
+        # Check authentication
+        auth_error = ApartmentAPI._check_authentication()
+        if auth_error:
+            return auth_error
+        
+        if not items:
+            return {
+                "success": False,
+                "error": "Chưa có dịch vụ nào để tính phí"
+            }
+        
+        try:
+            requested = []
+            for item in items:
+                quantity = item.get('quantity')
+                # quantity = 0 là giá trị hợp lệ, chỉ mặc định 1 khi không truyền
+                requested.append((item['service_code'], 1.0 if quantity is None else float(quantity)))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            return {
+                "success": False,
+                "error": f"Danh sách dịch vụ không hợp lệ (cần service_code, quantity là số): {e!r}"
+            }
+        codes = list(dict.fromkeys(code for code, _ in requested))
+        
+        try:
+            rows = db.execute_query(_Q_SERVICE_FEES, (_jsonify(codes).decode(),))
+            services = {row['code']: row for row in rows}
+            
+            fees = []
+            not_found = []
+            grand_total = 0.0
+            for service_code, quantity in requested:
+                service = services.get(service_code)
+                if service is None:
+                    not_found.append(service_code)
+                    continue
+                
+                unit_price = float(service['unit_price'])
+                total = unit_price * quantity
+                grand_total += total
+                fee = {
+                    "service_code": service['code'],
+                    "service_name": service['name'],
+                    "unit": service['unit'],
+                    "unit_price": unit_price,
+                    "quantity": quantity,
+                    "total": total
+                }
+                if include_formatted:
+                    fee["unit_price_formatted"] = _FMT_VND(unit_price)
+                    fee["total_formatted"] = _FMT_VND(total)
+                fees.append(fee)
+            
+            if not fees:
+                return {
+                    "success": False,
+                    "error": f"Không tìm thấy dịch vụ với mã: {', '.join(not_found)}"
+                }
+            
+            data = {
+                "items": fees,
+                "not_found": not_found,
+                "grand_total": grand_total
+            }
+            if include_formatted:
+                data["grand_total_formatted"] = _FMT_VND(grand_total)
+            
+            return {
+                "success": True,
+                "data": data
+            }
+        except Exception as e:
+            logger.exception("Error in calculate_service_fees: %s", _db_error_message(e))
+            return {
+                "success": False,
+                "error": _db_error_message(e)
+            }
+    
+    @staticmethod
+    @_cached(ttl=300)
     def get_service_categories() -> Dict[str, Any]:
         """
         Lấy danh sách categories
@@ -264,20 +757,9 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT 
-            category_id,
-            name,
-            description
-        FROM {schema}.service_type_categories
-        ORDER BY name
-        """
         
         try:
-            results = db.execute_query(query)
-            
-            # Convert data types
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(_Q_SERVICE_CATEGORIES)
             
             return {
                 "success": True,
@@ -285,7 +767,7 @@ class ApartmentAPI:
                 "count": len(results)
             }
         except Exception as e:
-            print(f"❌ Error in get_service_categories: {e}")
+            logger.exception("Error in get_service_categories")
             return {
                 "success": False,
                 "error": str(e),
@@ -296,10 +778,13 @@ class ApartmentAPI:
     # ==================== AMENITIES FUNCTIONS ====================
 
     @staticmethod
+    @_cached(ttl=300)
     def get_amenities(
         category_name: Optional[str] = None,
         status: Optional[str] = "ACTIVE",
-        has_monthly_package: Optional[bool] = None
+        has_monthly_package: Optional[bool] = None,
+        summary: bool = False,
+        include_formatted: bool = False
     ) -> Dict[str, Any]:
         """
         Lấy danh sách tiện ích trong chung cư
@@ -308,6 +793,8 @@ class ApartmentAPI:
             category_name: Lọc theo loại tiện ích (Gym, Pool, Meeting Room...)
             status: Trạng thái (ACTIVE, INACTIVE, MAINTENANCE)
             has_monthly_package: Lọc tiện ích có gói tháng
+            summary: Chỉ lấy các cột chính (bỏ requires_face_verification, asset_id)
+            include_formatted: Thêm price_formatted ("100,000 VND") cho gói rẻ nhất
 
         Returns:
             Dict với data và count
@@ -317,61 +804,37 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT
-            amenity_id,
-            code,
-            name,
-            category_name,
-            location,
-            has_monthly_package,
-            fee_type,
-            status,
-            requires_face_verification,
-            asset_id
-        FROM {schema}.amenities
-        WHERE is_delete = 0
-        """
-        params = []
-
-        if category_name:
-            query += " AND category_name = ?"
-            params.append(category_name)
-
-        if status:
-            query += " AND status = ?"
-            params.append(status)
-
+        query = _Q_AMENITIES_SUMMARY if summary else _Q_AMENITIES_FULL
+        
+        category_name = category_name or None
+        status = status or None
         if has_monthly_package is not None:
-            query += " AND has_monthly_package = ?"
-            params.append(1 if has_monthly_package else 0)
-
-        query += " ORDER BY category_name, name"
+            has_monthly_package = 1 if has_monthly_package else 0
+        params = (
+            category_name, category_name,
+            status, status,
+            has_monthly_package, has_monthly_package
+        )
 
         try:
-            results = db.execute_query(query, tuple(params) if params else None)
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(query, params)
 
-            # Thêm thông tin giá gói rẻ nhất cho mỗi tiện ích (nếu có)
+            # Gom các cột gói rẻ nhất thành cheapest_package
             for amenity in results:
-                if amenity.get('has_monthly_package'):
-                    packages_result = ApartmentAPI.get_amenity_packages(
-                        amenity_code=amenity['code'],
-                        status='ACTIVE'
-                    )
-                    if packages_result['success'] and packages_result['count'] > 0:
-                        # Lấy gói rẻ nhất
-                        cheapest = min(packages_result['data'], key=lambda x: x.get('price', float('inf')))
-                        amenity['cheapest_package'] = {
-                            'name': cheapest.get('package_name', ''),
-                            'price': cheapest.get('price', 0),
-                            'price_formatted': cheapest.get('price_formatted', '0 VND'),
-                            'month_count': cheapest.get('month_count', 0)
-                        }
-                        amenity['total_packages'] = packages_result['count']
-                    else:
-                        amenity['cheapest_package'] = None
-                        amenity['total_packages'] = 0
+                package_name = amenity.pop('cheapest_package_name')
+                month_count = amenity.pop('cheapest_month_count')
+                price = amenity.pop('cheapest_price')
+                total_packages = amenity.pop('total_packages')
+
+                if total_packages:
+                    amenity['cheapest_package'] = {
+                        'name': package_name or '',
+                        'price': price or 0,
+                        'month_count': month_count or 0
+                    }
+                    if include_formatted:
+                        amenity['cheapest_package']['price_formatted'] = _FMT_VND(price) if price else '0 VND'
+                    amenity['total_packages'] = total_packages
                 else:
                     amenity['cheapest_package'] = None
                     amenity['total_packages'] = 0
@@ -382,7 +845,7 @@ class ApartmentAPI:
                 "count": len(results)
             }
         except Exception as e:
-            print(f"❌ Error in get_amenities: {e}")
+            logger.exception("Error in get_amenities")
             return {
                 "success": False,
                 "error": str(e),
@@ -391,12 +854,13 @@ class ApartmentAPI:
             }
 
     @staticmethod
-    def get_amenity_by_code(code: str) -> Dict[str, Any]:
+    def get_amenity_by_code(code: str, include_formatted: bool = False) -> Dict[str, Any]:
         """
         Lấy thông tin chi tiết tiện ích theo mã (bao gồm cả thông tin giá nếu có)
 
         Args:
             code: Mã tiện ích
+            include_formatted: Thêm price_formatted ("100,000 VND") cho mỗi gói
 
         Returns:
             Dict với thông tin tiện ích và giá gói (nếu có)
@@ -406,41 +870,39 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT
-            amenity_id,
-            code,
-            name,
-            category_name,
-            location,
-            has_monthly_package,
-            fee_type,
-            status,
-            requires_face_verification,
-            asset_id
-        FROM {schema}.amenities
-        WHERE code = ? AND is_delete = 0
-        """
-
         try:
-            results = db.execute_query(query, (code,))
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(_Q_AMENITY_BY_CODE, (code,))
 
             if results:
-                amenity_data = results[0]
-
-                # Nếu có gói tháng, lấy thông tin giá
-                if amenity_data.get('has_monthly_package'):
-                    packages_result = ApartmentAPI.get_amenity_packages(amenity_code=code, status='ACTIVE')
-                    if packages_result['success'] and packages_result['count'] > 0:
-                        amenity_data['packages'] = packages_result['data']
-                        amenity_data['package_count'] = packages_result['count']
-                    else:
-                        amenity_data['packages'] = []
-                        amenity_data['package_count'] = 0
-                else:
-                    amenity_data['packages'] = []
-                    amenity_data['package_count'] = 0
+                first = results[0]
+                amenity_data = {column: first[column] for column in _AMENITY_COLUMNS}
+
+                # Gom các dòng gói tháng của tiện ích thành list packages
+                packages = []
+                for row in results:
+                    if row['amenity_id'] != amenity_data['amenity_id']:
+                        break
+                    if row['package_id'] is None:
+                        continue
+                    package = {
+                        'package_id': row['package_id'],
+                        'amenity_id': row['amenity_id'],
+                        'amenity_code': row['code'],
+                        'amenity_name': row['name'],
+                        'package_name': row['package_name'],
+                        'month_count': row['month_count'],
+                        'price': row['price'],
+                        'description': row['description'],
+                        'status': row['package_status'],
+                        'duration_days': row['duration_days'],
+                        'period_unit': row['period_unit']
+                    }
+                    if include_formatted and row['price']:
+                        package['price_formatted'] = _FMT_VND(row['price'])
+                    packages.append(package)
+
+                amenity_data['packages'] = packages
+                amenity_data['package_count'] = len(packages)
 
                 return {
                     "success": True,
@@ -452,7 +914,7 @@ class ApartmentAPI:
                     "error": f"Không tìm thấy tiện ích với mã: {code}"
                 }
         except Exception as e:
-            print(f"❌ Error in get_amenity_by_code: {e}")
+            logger.exception("Error in get_amenity_by_code")
             return {
                 "success": False,
                 "error": str(e)
@@ -461,7 +923,8 @@ class ApartmentAPI:
     @staticmethod
     def get_amenity_packages(
         amenity_code: Optional[str] = None,
-        status: Optional[str] = "ACTIVE"
+        status: Optional[str] = "ACTIVE",
+        include_formatted: bool = False
     ) -> Dict[str, Any]:
         """
         Lấy danh sách gói dịch vụ tiện ích (monthly packages)
@@ -469,6 +932,7 @@ class ApartmentAPI:
         Args:
             amenity_code: Mã tiện ích cần xem gói
             status: Trạng thái gói (ACTIVE, INACTIVE)
+            include_formatted: Thêm price_formatted ("100,000 VND") cho mỗi gói
 
         Returns:
             Dict với data và count
@@ -478,43 +942,17 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT
-            ap.package_id,
-            ap.amenity_id,
-            a.code as amenity_code,
-            a.name as amenity_name,
-            ap.name as package_name,
-            ap.month_count,
-            ap.price,
-            ap.description,
-            ap.status,
-            ap.duration_days,
-            ap.period_unit
-        FROM {schema}.amenity_packages ap
-        INNER JOIN {schema}.amenities a ON ap.amenity_id = a.amenity_id
-        WHERE 1=1
-        """
-        params = []
-
-        if amenity_code:
-            query += " AND a.code = ?"
-            params.append(amenity_code)
-
-        if status:
-            query += " AND ap.status = ?"
-            params.append(status)
-
-        query += " ORDER BY a.name, ap.month_count"
+        amenity_code = amenity_code or None
+        status = status or None
 
         try:
-            results = db.execute_query(query, tuple(params) if params else None)
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(_Q_AMENITY_PACKAGES, (amenity_code, amenity_code, status, status))
 
-            # Format giá tiền
-            for row in results:
-                if 'price' in row and row['price']:
-                    row['price_formatted'] = f"{row['price']:,.0f} VND"
+            # Format giá tiền (chatbot tự format nên mặc định bỏ qua)
+            if include_formatted:
+                for row in results:
+                    if row['price']:
+                        row['price_formatted'] = _FMT_VND(row['price'])
 
             return {
                 "success": True,
@@ -522,7 +960,7 @@ class ApartmentAPI:
                 "count": len(results)
             }
         except Exception as e:
-            print(f"❌ Error in get_amenity_packages: {e}")
+            logger.exception("Error in get_amenity_packages")
             return {
                 "success": False,
                 "error": str(e),
@@ -533,7 +971,8 @@ class ApartmentAPI:
     @staticmethod
     def calculate_amenity_package_price(
         amenity_code: str,
-        month_count: int = 1
+        month_count: int = 1,
+        include_formatted: bool = False
     ) -> Dict[str, Any]:
         """
         Tính giá gói tiện ích theo số tháng
@@ -541,6 +980,7 @@ class ApartmentAPI:
         Args:
             amenity_code: Mã tiện ích
             month_count: Số tháng đăng ký
+            include_formatted: Thêm price_formatted ("100,000 VND")
 
         Returns:
             Dict với thông tin tính toán
@@ -550,43 +990,28 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT TOP 1
-            a.code,
-            a.name as amenity_name,
-            ap.name as package_name,
-            ap.month_count,
-            ap.price,
-            ap.duration_days,
-            ap.period_unit
-        FROM {schema}.amenity_packages ap
-        INNER JOIN {schema}.amenities a ON ap.amenity_id = a.amenity_id
-        WHERE a.code = ?
-            AND ap.month_count = ?
-            AND ap.status = 'ACTIVE'
-        ORDER BY ap.price ASC
-        """
-
         try:
-            results = db.execute_query(query, (amenity_code, month_count))
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(_Q_AMENITY_PACKAGE_PRICE, (amenity_code, month_count))
 
             if results:
                 package = results[0]
                 price = float(package['price'])
 
+                package_price = {
+                    "amenity_code": package['code'],
+                    "amenity_name": package['amenity_name'],
+                    "package_name": package['package_name'],
+                    "month_count": package['month_count'],
+                    "duration_days": package['duration_days'],
+                    "period_unit": package['period_unit'],
+                    "price": price
+                }
+                if include_formatted:
+                    package_price["price_formatted"] = _FMT_VND(price)
+
                 return {
                     "success": True,
-                    "data": {
-                        "amenity_code": package['code'],
-                        "amenity_name": package['amenity_name'],
-                        "package_name": package['package_name'],
-                        "month_count": package['month_count'],
-                        "duration_days": package['duration_days'],
-                        "period_unit": package['period_unit'],
-                        "price": price,
-                        "price_formatted": f"{price:,.0f} VND"
-                    }
+                    "data": package_price
                 }
             else:
                 return {
@@ -594,15 +1019,109 @@ class ApartmentAPI:
                     "error": f"Không tìm thấy gói {month_count} tháng cho tiện ích {amenity_code}"
                 }
         except Exception as e:
-            print(f"❌ Error in calculate_amenity_package_price: {e}")
+            logger.exception("Error in calculate_amenity_package_price")
             return {
                 "success": False,
                 "error": str(e)
             }
 
+    @staticmethod
+    def calculate_amenity_package_prices(
+        items: List[Dict[str, Any]],
+        include_formatted: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Tính giá nhiều gói tiện ích cùng lúc (1 query cho tất cả tiện ích)
+
+        Args:
+            items: Danh sách {"amenity_code": str, "month_count": int}
+            include_formatted: Thêm các field *_formatted ("100,000 VND")
+
+        Returns:
+            Dict với chi tiết từng gói và tổng cộng
+        """
+        # Check authentication
+        auth_error = ApartmentAPI._check_authentication()
+        if auth_error:
+            return auth_error
+
+        if not items:
+            return {
+                "success": False,
+                "error": "Chưa có gói tiện ích nào để tính giá"
+            }
+
+        try:
+            requested = []
+            for item in items:
+                month_count = item.get('month_count')
+                requested.append((item['amenity_code'], 1 if month_count is None else int(month_count)))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            return {
+                "success": False,
+                "error": f"Danh sách gói tiện ích không hợp lệ (cần amenity_code, month_count là số): {e!r}"
+            }
+        codes = list(dict.fromkeys(code for code, _ in requested))
+
+        try:
+            packages = {
+                (row['code'], row['month_count']): row
+                for row in db.execute_query(_Q_AMENITY_PACKAGE_PRICES, (_jsonify(codes).decode(),))
+            }
+
+            prices = []
+            not_found = []
+            grand_total = 0.0
+            for amenity_code, month_count in requested:
+                package = packages.get((amenity_code, month_count))
+                if package is None:
+                    not_found.append(f"{amenity_code} ({month_count} tháng)")
+                    continue
+
+                price = float(package['price'])
+                grand_total += price
+                package_price = {
+                    "amenity_code": package['code'],
+                    "amenity_name": package['amenity_name'],
+                    "package_name": package['package_name'],
+                    "month_count": package['month_count'],
+                    "duration_days": package['duration_days'],
+                    "period_unit": package['period_unit'],
+                    "price": price
+                }
+                if include_formatted:
+                    package_price["price_formatted"] = _FMT_VND(price)
+                prices.append(package_price)
+
+            if not prices:
+                return {
+                    "success": False,
+                    "error": f"Không tìm thấy gói tiện ích: {', '.join(not_found)}"
+                }
+
+            data = {
+                "items": prices,
+                "not_found": not_found,
+                "grand_total": grand_total
+            }
+            if include_formatted:
+                data["grand_total_formatted"] = _FMT_VND(grand_total)
+
+            return {
+                "success": True,
+                "data": data
+            }
+        except Exception as e:
+            logger.exception("Error in calculate_amenity_package_prices: %s", _db_error_message(e))
+            return {
+                "success": False,
+                "error": _db_error_message(e)
+            }
+
     # ==================== APARTMENTS & FLOORS FUNCTIONS ====================
 
     @staticmethod
+    @_cached(ttl=300)
     def get_floors() -> Dict[str, Any]:
         """
         Lấy danh sách các tầng trong toà nhà
@@ -615,18 +1134,8 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT
-            floor_id,
-            floor_number,
-            name
-        FROM {schema}.floors
-        ORDER BY floor_number
-        """
-
         try:
-            results = db.execute_query(query)
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(_Q_FLOORS)
 
             return {
                 "success": True,
@@ -634,7 +1143,7 @@ class ApartmentAPI:
                 "count": len(results)
             }
         except Exception as e:
-            print(f"❌ Error in get_floors: {e}")
+            logger.exception("Error in get_floors")
             return {
                 "success": False,
                 "error": str(e),
@@ -642,6 +1151,48 @@ class ApartmentAPI:
                 "count": 0
             }
 
+    @staticmethod
+    def iter_apartments(
+        floor_number: Optional[int] = None,
+        status: Optional[str] = None,
+        apartment_type: Optional[str] = None,
+        min_bedrooms: Optional[int] = None,
+        max_bedrooms: Optional[int] = None,
+        min_area: Optional[float] = None,
+        max_area: Optional[float] = None,
+        summary: bool = False,
+        batch_size: int = 500
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Duyệt danh sách căn hộ theo từng row (đọc cursor theo batch, không load hết vào RAM)
+
+        Args: giống get_apartments, thêm batch_size (số row mỗi lần fetchmany)
+
+        Returns:
+            Generator các row căn hộ (ApartmentRow nếu summary, ngược lại ApartmentDetailRow)
+
+        Raises:
+            ValueError: Nếu chưa đăng nhập (không có schema)
+        """
+        query = _Q_APARTMENTS_SUMMARY if summary else _Q_APARTMENTS_FULL
+        
+        status = status or None
+        apartment_type = apartment_type or None
+        # Mỗi bộ lọc được bind 2 lần: (? IS NULL OR column = ?)
+        params = (
+            floor_number, floor_number,
+            status, status,
+            apartment_type, apartment_type,
+            min_bedrooms, min_bedrooms,
+            max_bedrooms, max_bedrooms,
+            min_area, min_area,
+            max_area, max_area
+        )
+
+        row_class = ApartmentRow if summary else ApartmentDetailRow
+
+        return db.iter_query(query, params, batch_size=batch_size, row_class=row_class)
+
     @staticmethod
     def get_apartments(
         floor_number: Optional[int] = None,
@@ -650,7 +1201,8 @@ class ApartmentAPI:
         min_bedrooms: Optional[int] = None,
         max_bedrooms: Optional[int] = None,
         min_area: Optional[float] = None,
-        max_area: Optional[float] = None
+        max_area: Optional[float] = None,
+        summary: bool = False
     ) -> Dict[str, Any]:
         """
         Lấy danh sách căn hộ với các bộ lọc
@@ -663,6 +1215,7 @@ class ApartmentAPI:
             max_bedrooms: Số phòng ngủ tối đa
             min_area: Diện tích tối thiểu (m2)
             max_area: Diện tích tối đa (m2)
+            summary: Chỉ lấy các cột chính (bỏ floor_id, floor_name, created_at, updated_at)
 
         Returns:
             Dict với data và count
@@ -671,59 +1224,18 @@ class ApartmentAPI:
         auth_error = ApartmentAPI._check_authentication()
         if auth_error:
             return auth_error
-        
-        query = """
-        SELECT
-            a.apartment_id,
-            a.floor_id,
-            f.floor_number,
-            f.name as floor_name,
-            a.number as apartment_number,
-            a.area_m2,
-            a.bedrooms,
-            a.status,
-            a.type,
-            a.created_at,
-            a.updated_at
-        FROM {schema}.apartments a
-        INNER JOIN {schema}.floors f ON a.floor_id = f.floor_id
-        WHERE 1=1
-        """
-        params = []
-
-        if floor_number is not None:
-            query += " AND f.floor_number = ?"
-            params.append(floor_number)
-
-        if status:
-            query += " AND a.status = ?"
-            params.append(status)
-
-        if apartment_type:
-            query += " AND a.type = ?"
-            params.append(apartment_type)
-
-        if min_bedrooms is not None:
-            query += " AND a.bedrooms >= ?"
-            params.append(min_bedrooms)
-
-        if max_bedrooms is not None:
-            query += " AND a.bedrooms <= ?"
-            params.append(max_bedrooms)
-
-        if min_area is not None:
-            query += " AND a.area_m2 >= ?"
-            params.append(min_area)
-
-        if max_area is not None:
-            query += " AND a.area_m2 <= ?"
-            params.append(max_area)
-
-        query += " ORDER BY f.floor_number, a.number"
 
         try:
-            results = db.execute_query(query, tuple(params) if params else None)
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = list(ApartmentAPI.iter_apartments(
+                floor_number=floor_number,
+                status=status,
+                apartment_type=apartment_type,
+                min_bedrooms=min_bedrooms,
+                max_bedrooms=max_bedrooms,
+                min_area=min_area,
+                max_area=max_area,
+                summary=summary
+            ))
 
             return {
                 "success": True,
@@ -731,7 +1243,7 @@ class ApartmentAPI:
                 "count": len(results)
             }
         except Exception as e:
-            print(f"❌ Error in get_apartments: {e}")
+            logger.exception("Error in get_apartments")
             return {
                 "success": False,
                 "error": str(e),
@@ -755,28 +1267,8 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT
-            a.apartment_id,
-            a.floor_id,
-            f.floor_number,
-            f.name as floor_name,
-            a.number as apartment_number,
-            a.area_m2,
-            a.bedrooms,
-            a.status,
-            a.type,
-            a.image,
-            a.created_at,
-            a.updated_at
-        FROM {schema}.apartments a
-        INNER JOIN {schema}.floors f ON a.floor_id = f.floor_id
-        WHERE a.number = ?
-        """
-
         try:
-            results = db.execute_query(query, (apartment_number,))
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(_Q_APARTMENT_BY_NUMBER, (apartment_number,))
 
             if results:
                 return {
@@ -789,7 +1281,7 @@ class ApartmentAPI:
                     "error": f"Không tìm thấy căn hộ số: {apartment_number}"
                 }
         except Exception as e:
-            print(f"❌ Error in get_apartment_by_number: {e}")
+            logger.exception("Error in get_apartment_by_number")
             return {
                 "success": False,
                 "error": str(e)
@@ -809,14 +1301,46 @@ class ApartmentAPI:
 
         Returns:
             Dict với data và count
+        
+        Note:
+            Query dùng literal status = 'AVAILABLE' (không bind tham số) để SQL Server
+            có thể dùng filtered index cho căn trống. Migration đề xuất:
+            
+                CREATE INDEX IX_apartments_status_available
+                ON {schema}.apartments (type, bedrooms)
+                INCLUDE (floor_id, number, area_m2)
+                WHERE status = 'AVAILABLE'
         """
-        return ApartmentAPI.get_apartments(
-            status="AVAILABLE",
-            apartment_type=apartment_type,
-            min_bedrooms=min_bedrooms
-        )
+        # Check authentication
+        auth_error = ApartmentAPI._check_authentication()
+        if auth_error:
+            return auth_error
+        
+        apartment_type = apartment_type or None
+        
+        try:
+            results = db.execute_query(
+                _Q_AVAILABLE_APARTMENTS,
+                (apartment_type, apartment_type, min_bedrooms, min_bedrooms),
+                row_class=ApartmentDetailRow
+            )
+            
+            return {
+                "success": True,
+                "data": results,
+                "count": len(results)
+            }
+        except Exception as e:
+            logger.exception("Error in get_available_apartments")
+            return {
+                "success": False,
+                "error": str(e),
+                "data": [],
+                "count": 0
+            }
 
     @staticmethod
+    @_cached(ttl=60)
     def get_apartment_statistics() -> Dict[str, Any]:
         """
         Thống kê tổng quan về căn hộ
@@ -829,36 +1353,25 @@ class ApartmentAPI:
         if auth_error:
             return auth_error
         
-        query = """
-        SELECT
-            COUNT(*) as total_apartments,
-            SUM(CASE WHEN status = 'AVAILABLE' THEN 1 ELSE 0 END) as available,
-            SUM(CASE WHEN status = 'OCCUPIED' THEN 1 ELSE 0 END) as occupied,
-            SUM(CASE WHEN status = 'RESERVED' THEN 1 ELSE 0 END) as reserved,
-            SUM(CASE WHEN status = 'MAINTENANCE' THEN 1 ELSE 0 END) as maintenance,
-            AVG(CAST(area_m2 AS FLOAT)) as avg_area,
-            MIN(area_m2) as min_area,
-            MAX(area_m2) as max_area
-        FROM {schema}.apartments
-        """
-
         try:
-            results = db.execute_query(query)
-            results = ApartmentAPI._convert_to_serializable(results)
+            results = db.execute_query(_Q_APARTMENT_STATISTICS)
 
-            if results:
-                stats = results[0]
+            totals = next((row for row in results if row['is_total']), None)
+            if totals:
+                counts = {row['status']: row['apartment_count'] for row in results if not row['is_total']}
+                area_count = totals['area_count']
+                avg_area = float(totals['total_area']) / area_count if area_count else 0
                 return {
                     "success": True,
                     "data": {
-                        "total_apartments": stats.get('total_apartments', 0),
-                        "available": stats.get('available', 0),
-                        "occupied": stats.get('occupied', 0),
-                        "reserved": stats.get('reserved', 0),
-                        "maintenance": stats.get('maintenance', 0),
-                        "avg_area_m2": round(stats.get('avg_area', 0), 2),
-                        "min_area_m2": stats.get('min_area', 0),
-                        "max_area_m2": stats.get('max_area', 0)
+                        "total_apartments": totals['apartment_count'],
+                        "available": counts.get('AVAILABLE', 0),
+                        "occupied": counts.get('OCCUPIED', 0),
+                        "reserved": counts.get('RESERVED', 0),
+                        "maintenance": counts.get('MAINTENANCE', 0),
+                        "avg_area_m2": round(avg_area, 2),
+                        "min_area_m2": totals['min_area'] or 0,
+                        "max_area_m2": totals['max_area'] or 0
                     }
                 }
             else:
@@ -867,7 +1380,7 @@ class ApartmentAPI:
                     "error": "Không có dữ liệu thống kê"
                 }
         except Exception as e:
-            print(f"❌ Error in get_apartment_statistics: {e}")
+            logger.exception("Error in get_apartment_statistics")
             return {
                 "success": False,
                 "error": str(e)
@@ -3,20 +3,54 @@
 FastAPI Backend cho Apartment Chatbot
 Để tích hợp với ReactJS frontend
 """
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, Dict, Tuple
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, constr
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from typing import AsyncIterator, Optional
 from gemini_bot import GeminiChatbot
 from middleware.auth_middleware import JWTAuthMiddleware
 from schema.schema_context import get_current_schema
-import uuid
+from session.session_cache import SessionCache
+from session.redis_store import create_session_store
+import asyncio
+import itertools
+import logging
+import logging.handlers
+import orjson
+import os
+import queue
+import secrets
+import weakref
+
+# Logging không block: handlers ghi log chạy trong thread riêng của QueueListener
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.StreamHandler(),
+    respect_handler_level=True
+)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
+)
+logger = logging.getLogger(__name__)
+
+def _new_sid() -> str:
+    """Sinh session id ngẫu nhiên (128 bit, base64 url-safe)"""
+    return secrets.token_urlsafe(16)
 
 # Khởi tạo FastAPI app
 app = FastAPI(
     title="Apartment Chatbot API",
     description="Backend API cho chatbot quản lý chung cư",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse  # orjson encode nhanh hơn json chuẩn
 )
 
 # CORS - Cho phép ReactJS gọi API
@@ -31,15 +65,203 @@ app.add_middleware(
 # JWT Authentication Middleware - Phải add sau CORS
 app.add_middleware(JWTAuthMiddleware)
 
-# Lưu trữ chat sessions cho nhiều users
+# Giới hạn kích thước body (chặn sớm theo Content-Length, trước cả auth)
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", "16384"))
+
+class BodySizeLimitMiddleware:
+    """
+    Chặn body lớn hơn max_bytes
+
+    Content-Length khai báo quá lớn → 413 ngay; body không có Content-Length (chunked)
+    thì đếm số byte thực nhận và báo 413 khi vượt
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = ORJSONResponse(status_code=413, content={"detail": "Request body too large"})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI trả HTTPException khi đọc body thành response 413
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_BODY_BYTES)
+
+# Rate limit /chat theo user đã xác thực hoặc theo IP (chưa đăng nhập / token không hợp lệ)
+# Sau reverse proxy, IP client lấy từ X-Forwarded-For chỉ khi request đến từ IP trong
+# FORWARDED_ALLOW_IPS (uvicorn --proxy-headers), nếu không mọi user chung 1 IP của proxy
+CHAT_RATE_LIMIT = os.getenv("CHAT_RATE_LIMIT", "30/minute")
+
+def _rate_limit_key(request: Request) -> str:
+    # Chỉ dùng thông tin từ token đã verify (middleware set request.state), không dùng header thô:
+    # đổi token rác mỗi request không được tính là 1 client mới
+    if getattr(request.state, "is_authenticated", False):
+        payload = getattr(request.state, "user_info", None) or {}
+        if payload.get("sub"):
+            return f"user:{payload['sub']}"
+        return f"building:{request.state.building_id}"
+    return get_remote_address(request)
+
+limiter = Limiter(key_func=_rate_limit_key)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+# Lưu trữ chat sessions cho nhiều users (LRU + TTL để RAM không tăng mãi)
 # Key: session_id, Value: (GeminiChatbot instance, schema_name)
-chat_sessions: Dict[str, Tuple[GeminiChatbot, Optional[str]]] = {}
+chat_sessions = SessionCache(
+    capacity=int(os.getenv("SESSION_CAPACITY", "1000")),
+    ttl_seconds=int(os.getenv("SESSION_TTL_SECONDS", "1800"))
+)
+# Lock theo session_id, giữ suốt 1 lượt chat (lấy chatbot → Gemini → lưu lượt) để 2 request
+# cùng session không chen lịch sử của nhau. Session khác nhau không chờ nhau;
+# lock tự mất khi không còn request nào giữ
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+_session_sweeper: Optional[asyncio.Task] = None
+
+# GET /sessions liệt kê session_id của mọi user → chỉ bật khi debug
+EXPOSE_SESSIONS_DEBUG = os.getenv("EXPOSE_SESSIONS_DEBUG", "").lower() in ("1", "true", "yes")
+
+# Bot giới thiệu dùng chung cho mọi user chưa đăng nhập (stateless, không giữ lịch sử)
+intro_bot = GeminiChatbot(schema_name=None)
+
+# Session store dùng chung giữa các worker (chỉ khi có REDIS_URL)
+# chat_sessions khi đó chỉ là LRU các GeminiChatbot đã dựng sẵn trong worker này
+session_store = create_session_store()
+
+# ==================== LIFECYCLE ====================
+
+@app.on_event("startup")
+async def start_log_listener():
+    """Bắt đầu thread ghi log từ queue"""
+    _log_listener.start()
+
+async def _sweep_sessions_forever():
+    """Định kỳ xóa các session không hoạt động quá TTL"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        expired = chat_sessions.sweep()
+        if expired:
+            logger.info("Swept %d expired chat sessions", expired)
+
+@app.on_event("startup")
+async def start_session_sweeper():
+    """Chạy task dọn session hết hạn"""
+    global _session_sweeper
+    _session_sweeper = asyncio.create_task(_sweep_sessions_forever())
+
+@app.on_event("shutdown")
+async def stop_session_sweeper():
+    """Dừng task dọn session"""
+    if _session_sweeper is not None:
+        _session_sweeper.cancel()
+
+@app.on_event("shutdown")
+async def close_session_store():
+    """Đóng kết nối Redis"""
+    if session_store is not None:
+        await session_store.close()
+
+@app.on_event("shutdown")
+async def stop_log_listener():
+    """Flush log còn trong queue và dừng thread ghi log"""
+    _log_listener.stop()
+
+async def _load_session(session_id: str, schema_name: str) -> Optional[GeminiChatbot]:
+    """
+    Lấy chatbot của session đã đăng nhập
+
+    Ưu tiên bản trong RAM của worker; khi dùng Redis thì chỉ dùng bản trong RAM
+    nếu nó đã đồng bộ với lượt mới nhất, ngược lại dựng lại từ lịch sử trên Redis
+    """
+    session = chat_sessions.get(session_id)
+
+    if session_store is None:
+        if session is None:
+            return None
+        chatbot, old_schema = session
+        # Nếu schema thay đổi, reset chatbot với schema mới
+        if old_schema != schema_name:
+            if chatbot and chatbot.chat_session:
+                chatbot.start_new_conversation()
+            chatbot = GeminiChatbot(schema_name=schema_name)
+            chat_sessions.put(session_id, chatbot, schema_name)
+        return chatbot
+
+    meta = await session_store.get(session_id)
+    if meta is None:
+        chat_sessions.pop(session_id)
+        return None
+
+    if session is not None:
+        chatbot, old_schema = session
+        if old_schema == schema_name and chatbot.synced_at == meta["last_activity"]:
+            return chatbot
+
+    chatbot = GeminiChatbot(schema_name=schema_name)
+    # Chỉ dùng lại lịch sử khi vẫn cùng building
+    if meta["schema"] == schema_name:
+        chatbot.restore_history(await session_store.load_history(session_id))
+        chatbot.synced_at = meta["last_activity"]
+    else:
+        await session_store.clear_history(session_id)
+        chatbot.synced_at = await session_store.save(session_id, schema_name)
+    chat_sessions.put(session_id, chatbot, schema_name)
+    return chatbot
+
+def _session_lock(session_id: str) -> asyncio.Lock:
+    """Lock của session (tạo mới nếu chưa có request nào giữ)"""
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = _session_locks[session_id] = asyncio.Lock()
+    return lock
+
+async def _session_chatbot(session_id: str, schema_name: str) -> GeminiChatbot:
+    """
+    Lấy chatbot cho session của user đã đăng nhập (tạo lại nếu session không còn)
+
+    Phải gọi khi đang giữ _session_lock(session_id)
+    """
+    # Case 3: Có schema và có session cũ
+    chatbot = await _load_session(session_id, schema_name)
+    # Case 2: session mới / session_id không còn (hết hạn / đã xóa) → tạo chatbot mới
+    if chatbot is None:
+        chatbot = GeminiChatbot(schema_name=schema_name)
+        chat_sessions.put(session_id, chatbot, schema_name)
+    return chatbot
+
+async def _save_turn(chatbot: GeminiChatbot, session_id: str, schema_name: str) -> None:
+    """Lưu lượt hội thoại mới lên Redis"""
+    if session_store is not None:
+        chatbot.synced_at = await session_store.append_turn(
+            session_id,
+            schema_name,
+            chatbot.export_history(chatbot.last_turn_start())
+        )
 
 # ==================== REQUEST/RESPONSE MODELS ====================
 
 class ChatRequest(BaseModel):
     """Request body cho chat endpoint"""
-    message: str
+    message: constr(strip_whitespace=True, min_length=1, max_length=4000)
     session_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
@@ -66,14 +288,16 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "POST /chat": "Gửi tin nhắn đến chatbot",
+            "POST /chat/stream": "Gửi tin nhắn, nhận câu trả lời dạng stream (SSE)",
             "POST /session/new": "Tạo session mới",
             "DELETE /session/{session_id}": "Xóa session",
-            "GET /sessions": "Xem tất cả sessions"
+            "GET /sessions": "Xem sessions (debug, cần EXPOSE_SESSIONS_DEBUG)"
         }
     }
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest, http_request: Request):
+@limiter.limit(CHAT_RATE_LIMIT)
+async def chat(body: ChatRequest, request: Request):
     """
     Endpoint chính để chat với bot
 
@@ -91,68 +315,118 @@ async def chat(request: ChatRequest, http_request: Request):
         schema_name = get_current_schema()
         
         # Lấy hoặc tạo session
-        session_id = request.session_id
+        session_id = body.session_id
         
         # Xử lý session dựa trên authentication state
-        # Case 1: Không có schema (chưa đăng nhập) - tạo unauthenticated session
+        # Case 1: Không có schema (chưa đăng nhập) - dùng bot giới thiệu chung, không lưu session
         if schema_name is None:
             # Xóa session cũ nếu có
-            if session_id and session_id in chat_sessions:
-                del chat_sessions[session_id]
+            if session_id:
+                chat_sessions.pop(session_id)
             
-            # Tạo session mới cho unauthenticated user
-            session_id = str(uuid.uuid4())
-            chatbot = GeminiChatbot(schema_name=None)
-            chat_sessions[session_id] = (chatbot, None)
+            session_id = _new_sid()
+            result = await intro_bot.areply(body.message)
+            return _chat_response(result, session_id)
         
-        # Case 2: Có schema (đã đăng nhập) nhưng chưa có session
-        elif not session_id or session_id not in chat_sessions:
-            if not session_id:
-                session_id = str(uuid.uuid4())
-            chatbot = GeminiChatbot(schema_name=schema_name)
-            chat_sessions[session_id] = (chatbot, schema_name)
-        
-        # Case 3: Có schema và có session cũ
-        else:
-            chatbot, old_schema = chat_sessions[session_id]
-            
-            # Nếu schema thay đổi, reset chatbot với schema mới
-            if old_schema != schema_name:
-                if chatbot and chatbot.chat_session:
-                    chatbot.start_new_conversation()
-                chatbot = GeminiChatbot(schema_name=schema_name)
-                chat_sessions[session_id] = (chatbot, schema_name)
-
-        # Gọi chatbot
-        result = chatbot.chat(request.message)
-
-        if result["success"]:
-            return ChatResponse(
-                success=True,
-                response=result["response"],
-                session_id=session_id,
-                function_calls=result.get("function_calls", [])
-            )
-        else:
-            return ChatResponse(
-                success=False,
-                response="Xin lỗi, có lỗi xảy ra. Vui lòng thử lại.",
-                session_id=session_id,
-                error=result.get("error", "Unknown error")
-            )
+        # Case 2: Có schema (đã đăng nhập) nhưng chưa có session_id → session mới
+        session_id = session_id or _new_sid()
+        async with _session_lock(session_id):
+            chatbot = await _session_chatbot(session_id, schema_name)
+
+            # Gọi chatbot (async: chờ Gemini không chặn event loop, query DB chạy trong thread pool)
+            result = await chatbot.achat(body.message)
+
+            if result["success"]:
+                await _save_turn(chatbot, session_id, schema_name)
+
+        return _chat_response(result, session_id)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+@limiter.limit(CHAT_RATE_LIMIT)
+async def chat_stream(body: ChatRequest, request: Request):
+    """
+    Giống /chat nhưng trả câu trả lời dạng Server-Sent Events (text/event-stream)
+
+    Mỗi event là 1 dòng "data: <json>":
+        {"type": "delta", "text": "..."}       // từng đoạn câu trả lời
+        {"type": "done", ...ChatResponse}       // event cuối, cùng format với /chat
+    """
+    schema_name = get_current_schema()
+    session_id = body.session_id
+
+    if schema_name is None:
+        # User chưa đăng nhập: bot giới thiệu trả lời 1 lần (có cache/batch), gửi thành 1 delta
+        if session_id:
+            chat_sessions.pop(session_id)
+        session_id = _new_sid()
+        events = _intro_events(body.message)
+    else:
+        session_id = session_id or _new_sid()
+        events = _chat_events(body.message, session_id, schema_name)
+
+    return StreamingResponse(
+        _sse(events, session_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _intro_events(message: str) -> AsyncIterator[dict]:
+    result = await intro_bot.areply(message)
+    if result["success"]:
+        yield {"type": "delta", "text": result["response"]}
+    yield {"type": "done", **result}
+
+async def _chat_events(message: str, session_id: str, schema_name: str) -> AsyncIterator[dict]:
+    # Lock giữ đến khi stream xong (hoặc client ngắt kết nối)
+    async with _session_lock(session_id):
+        try:
+            chatbot = await _session_chatbot(session_id, schema_name)
+        except Exception as e:
+            yield {"type": "done", "success": False, "error": str(e)}
+            return
+        async for event in chatbot.achat_stream(message):
+            if event["type"] == "done" and event["success"]:
+                await _save_turn(chatbot, session_id, schema_name)
+            yield event
+
+async def _sse(events: AsyncIterator[dict], session_id: str) -> AsyncIterator[bytes]:
+    """Chuyển event của chatbot thành SSE; event done được format như ChatResponse"""
+    async for event in events:
+        if event["type"] == "done":
+            event = {"type": "done", **jsonable_encoder(_chat_response(event, session_id))}
+        yield b"data: " + orjson.dumps(event) + b"\n\n"
+
+def _chat_response(result: dict, session_id: str) -> ChatResponse:
+    """Chuyển kết quả của chatbot thành ChatResponse"""
+    if result["success"]:
+        return ChatResponse(
+            success=True,
+            response=result["response"],
+            session_id=session_id,
+            function_calls=result.get("function_calls", [])
+        )
+    else:
+        return ChatResponse(
+            success=False,
+            response="Xin lỗi, có lỗi xảy ra. Vui lòng thử lại.",
+            session_id=session_id,
+            error=result.get("error", "Unknown error")
+        )
+
 @app.post("/session/new", response_model=SessionResponse)
 async def create_session():
     """Tạo session mới cho user"""
     # Lấy schema từ context
     schema_name = get_current_schema()
     
-    session_id = str(uuid.uuid4())
+    session_id = _new_sid()
     chatbot = GeminiChatbot(schema_name=schema_name)
-    chat_sessions[session_id] = (chatbot, schema_name)
+    chat_sessions.put(session_id, chatbot, schema_name)
+    if session_store is not None and schema_name is not None:
+        chatbot.synced_at = await session_store.save(session_id, schema_name)
 
     return SessionResponse(
         session_id=session_id,
@@ -162,8 +436,10 @@ async def create_session():
 @app.delete("/session/{session_id}")
 async def delete_session(session_id: str):
     """Xóa session (khi user đóng chat)"""
-    if session_id in chat_sessions:
-        del chat_sessions[session_id]
+    deleted = chat_sessions.pop(session_id) is not None
+    if session_store is not None:
+        deleted = await session_store.delete(session_id) or deleted
+    if deleted:
         return {"message": f"Session {session_id} deleted"}
     else:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -171,27 +447,46 @@ async def delete_session(session_id: str):
 @app.post("/session/{session_id}/reset")
 async def reset_session(session_id: str):
     """Reset conversation trong session (giữ nguyên session_id)"""
-    if session_id in chat_sessions:
-        chatbot, schema_name = chat_sessions[session_id]
-        chatbot.start_new_conversation()
-        return {"message": f"Session {session_id} reset successfully"}
-    else:
+    session = chat_sessions.get(session_id)
+    synced_at = None
+    if session_store is not None:
+        meta = await session_store.get(session_id)
+        if meta is not None:
+            # Đổi last_activity để các worker khác bỏ bản lịch sử cũ trong RAM
+            await session_store.clear_history(session_id)
+            synced_at = await session_store.save(session_id, meta["schema"])
+
+    if session is None and synced_at is None:
         raise HTTPException(status_code=404, detail="Session not found")
 
+    if session is not None:
+        chatbot, schema_name = session
+        chatbot.start_new_conversation()
+        chatbot.synced_at = synced_at
+    return {"message": f"Session {session_id} reset successfully"}
+
 @app.get("/sessions")
-async def get_sessions():
-    """Xem tất cả sessions đang active (cho debug)"""
-    sessions_info = []
-    for sid, (bot, schema) in chat_sessions.items():
-        sessions_info.append({
+async def get_sessions(limit: int = Query(100, ge=1, le=1000), offset: int = Query(0, ge=0)):
+    """
+    Xem sessions đang active (cho debug, phân trang)
+
+    Chỉ bật khi EXPOSE_SESSIONS_DEBUG=true, ngược lại trả 404
+    """
+    if not EXPOSE_SESSIONS_DEBUG:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    sessions_info = [
+        {
             "session_id": sid,
             "schema": schema,
             "is_authenticated": schema is not None
-        })
+        }
+        for sid, (bot, schema) in itertools.islice(chat_sessions.items(), offset, offset + limit)
+    ]
     
     return {
         "total_sessions": len(chat_sessions),
-        "session_ids": list(chat_sessions.keys()),
+        "session_ids": [info["session_id"] for info in sessions_info],
         "sessions": sessions_info
     }
 
@@ -208,6 +503,26 @@ async def health_check():
 
 # ==================== RUN SERVER ====================
 
+def _worker_count() -> int:
+    """
+    Số worker uvicorn
+
+    WEB_CONCURRENCY nếu có; mặc định 1 worker khi session chỉ nằm trong RAM,
+    và 1 worker/CPU core khi có Redis (các worker dùng chung session)
+    """
+    workers = os.getenv("WEB_CONCURRENCY")
+    if workers:
+        workers = int(workers)
+        if workers > 1 and session_store is None:
+            logger.warning(
+                "WEB_CONCURRENCY=%d without REDIS_URL: sessions are not shared between workers",
+                workers
+            )
+        return workers
+    if session_store is None:
+        return 1
+    return os.cpu_count() or 1
+
 if __name__ == "__main__":
     import uvicorn
     print("\n" + "=" * 80)
@@ -219,4 +534,13 @@ if __name__ == "__main__":
     print("\n💡 Để test từ ReactJS, gọi POST http://localhost:8000/chat")
     print("\n" + "=" * 80 + "\n")
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" chọn uvloop + httptools khi đã cài (uvicorn[standard]; uvloop không có trên Windows)
+    # Nhiều worker cần import string "app:app"
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=_worker_count()
+    )
@@ -2,17 +2,98 @@
 JWT Token Handler
 Xử lý verify và decode JWT token từ Keycloak
 """
+import anyio
 import jwt
+import hashlib
+import logging
+import threading
+import time
 from typing import Optional, Dict
 import os
+from cachetools import TLRUCache
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Keycloak configuration từ environment variables
 KEYCLOAK_URL = os.getenv('KEYCLOAK_URL', '')
 KEYCLOAK_REALM = os.getenv('KEYCLOAK_REALM', '')
 KEYCLOAK_PUBLIC_KEY = os.getenv('KEYCLOAK_PUBLIC_KEY', '')
+# JWKS endpoint (vd: {KEYCLOAK_URL}/realms/{realm}/protocol/openid-connect/certs) để hỗ trợ xoay key
+KEYCLOAK_JWKS_URL = os.getenv('KEYCLOAK_JWKS_URL', '')
+
+
+def _load_public_key(key: str):
+    """Parse public key 1 lần (chấp nhận cả PEM lẫn chuỗi base64 copy từ Keycloak admin)"""
+    if not key.startswith('-----BEGIN'):
+        key = f"-----BEGIN PUBLIC KEY-----\n{key}\n-----END PUBLIC KEY-----"
+    return load_pem_public_key(key.encode())
+
+
+# Key object đã parse sẵn → jwt.decode không phải parse PEM mỗi lần verify
+_PUBLIC_KEY = _load_public_key(KEYCLOAK_PUBLIC_KEY) if KEYCLOAK_PUBLIC_KEY else None
+# PyJWKClient chỉ dùng để tải JWKS; signing key theo kid được giữ trong _jwks_keys
+_JWKS_CLIENT = jwt.PyJWKClient(
+    KEYCLOAK_JWKS_URL,
+    timeout=int(os.getenv('JWKS_TIMEOUT', '5'))
+) if KEYCLOAK_JWKS_URL else None
+# Tải lại JWKS (khi gặp kid lạ) tối đa 1 lần mỗi JWKS_REFRESH_INTERVAL giây
+# Token với kid lạ trong khoảng đó bị từ chối luôn, không gọi mạng (tránh token giả với kid ngẫu nhiên)
+JWKS_REFRESH_INTERVAL = int(os.getenv('JWKS_REFRESH_INTERVAL', '60'))
+_jwks_keys: Dict[str, jwt.PyJWK] = {}
+_jwks_fetched_at = float('-inf')
+_jwks_lock = threading.Lock()
+
+
+def _jwks_signing_key(kid: Optional[str]) -> jwt.PyJWK:
+    """
+    Signing key theo kid trong header token
+
+    Raises:
+        jwt.InvalidTokenError: Không có key cho kid (kể cả khi chưa đến lúc được tải lại JWKS)
+    """
+    global _jwks_keys, _jwks_fetched_at
+    key = _jwks_keys.get(kid) if kid else None
+    if key is not None:
+        return key
+
+    with _jwks_lock:
+        now = time.monotonic()
+        if now - _jwks_fetched_at < JWKS_REFRESH_INTERVAL:
+            raise jwt.InvalidTokenError(f"Unknown signing key id: {kid}")
+        _jwks_fetched_at = now
+
+    # Tải ngoài lock: các request khác trong lúc tải bị từ chối ngay thay vì chờ
+    try:
+        _jwks_keys = {jwk.key_id: jwk for jwk in _JWKS_CLIENT.get_signing_keys(refresh=True)}
+    except jwt.PyJWKClientError as e:
+        raise jwt.InvalidTokenError(f"Cannot load JWKS: {e}")
+    logger.info("Loaded %d signing keys from JWKS", len(_jwks_keys))
+
+    key = _jwks_keys.get(kid) if kid else None
+    if key is None:
+        raise jwt.InvalidTokenError(f"Unknown signing key id: {kid}")
+    return key
+
+# Cache payload đã verify theo token (key = SHA-256 của token)
+# Mỗi entry sống tối đa TOKEN_CACHE_TTL giây và không quá thời điểm exp của token
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', '300'))
+
+
+def _token_ttu(key: bytes, payload: Dict, now: float) -> float:
+    """Thời điểm hết hạn của entry trong cache (theo đồng hồ của TLRUCache)"""
+    ttl = TOKEN_CACHE_TTL
+    exp = payload.get('exp')
+    if isinstance(exp, (int, float)):
+        ttl = min(ttl, exp - time.time())
+    return now + ttl
+
+
+_token_cache: "TLRUCache[bytes, Dict]" = TLRUCache(maxsize=10_000, ttu=_token_ttu)
+_token_cache_lock = threading.Lock()
 
 
 def verify_keycloak_token(token: str) -> Dict:
@@ -29,43 +110,79 @@ def verify_keycloak_token(token: str) -> Dict:
         jwt.ExpiredSignatureError: Token đã hết hạn
         jwt.InvalidTokenError: Token không hợp lệ
     """
+    key = hashlib.sha256(token.encode()).digest()
+    payload = _cached_payload(key)
+    if payload is not None:
+        return payload
+
+    payload = _decode_token(token)
+    with _token_cache_lock:
+        _token_cache[key] = payload
+    return payload
+
+
+async def averify_keycloak_token(token: str) -> Dict:
+    """
+    Giống verify_keycloak_token, dùng trong async code
+
+    Token đã có trong cache trả về ngay; token mới được verify trong thread pool
+    (RSA + có thể phải tải JWKS qua mạng) để không chặn event loop
+    """
+    payload = _cached_payload(hashlib.sha256(token.encode()).digest())
+    if payload is not None:
+        return payload
+    return await anyio.to_thread.run_sync(verify_keycloak_token, token)
+
+
+def _cached_payload(key: bytes) -> Optional[Dict]:
+    with _token_cache_lock:
+        return _token_cache.get(key)
+
+
+def _decode_token(token: str) -> Dict:
+    """Decode (và verify nếu có public key) token, không qua cache"""
     try:
-        print(f"🔍 [JWT HANDLER] Attempting to decode token...")
-        print(f"🔍 [JWT HANDLER] KEYCLOAK_PUBLIC_KEY exists: {bool(KEYCLOAK_PUBLIC_KEY)}")
-        
         # Option 1: Verify với public key (nếu có)
-        if KEYCLOAK_PUBLIC_KEY:
-            print(f"🔍 [JWT HANDLER] Using public key verification")
+        if _PUBLIC_KEY is not None:
             # Decode và verify token
             payload = jwt.decode(
                 token,
-                KEYCLOAK_PUBLIC_KEY,
+                _PUBLIC_KEY,
                 algorithms=['RS256'],
                 options={"verify_signature": True}
             )
-            print(f"✅ [JWT HANDLER] Token verified with public key")
+            logger.debug("Token verified with public key")
+            return payload
+        
+        # Option 1b: Verify với key lấy từ JWKS của Keycloak (theo kid trong header)
+        if _JWKS_CLIENT is not None:
+            signing_key = _jwks_signing_key(jwt.get_unverified_header(token).get('kid'))
+            payload = jwt.decode(
+                token,
+                signing_key.key,
+                algorithms=['RS256'],
+                options={"verify_signature": True}
+            )
+            logger.debug("Token verified with JWKS key %s", signing_key.key_id)
             return payload
         
         # Option 2: Decode không verify (tạm thời cho development)
         # Trong production nên verify với Keycloak public key hoặc JWKS
-        print(f"🔍 [JWT HANDLER] Using decode without verification (development mode)")
         payload = jwt.decode(
             token,
             options={"verify_signature": False}  # Tắt verify tạm thời
         )
-        print(f"✅ [JWT HANDLER] Token decoded without verification")
+        logger.debug("Token decoded without verification (development mode)")
         return payload
         
     except jwt.ExpiredSignatureError as e:
-        print(f"❌ [JWT HANDLER] Token expired: {str(e)}")
+        logger.debug("Token expired: %s", e)
         raise ValueError("Token has expired")
     except jwt.InvalidTokenError as e:
-        print(f"❌ [JWT HANDLER] Invalid token: {str(e)}")
+        logger.debug("Invalid token: %s", e)
         raise ValueError(f"Invalid token: {str(e)}")
     except Exception as e:
-        print(f"❌ [JWT HANDLER] Unexpected error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Unexpected error decoding token")
         raise ValueError(f"Error decoding token: {str(e)}")
 
 
@@ -79,45 +196,29 @@ def extract_building_id(token_payload: Dict) -> Optional[str]:
     Returns:
         building_id hoặc None nếu không có
     """
-    # building_id có thể ở trong:
+    # building_id có thể ở trong (theo thứ tự ưu tiên):
     # - token_payload['building_id']
-    # - token_payload['realm_access']['roles'] (nếu dùng roles)
-    # - token_payload['resource_access'] (nếu dùng resource access)
-    
-    print(f"🔍 Searching for building_id in token payload...")
-    print(f"🔍 Available keys: {list(token_payload.keys())}")
-    
+    # - token_payload['custom_claims']['building_id']
+    # - token_payload['realm_access']['roles'] (role có chứa "building")
     building_id = token_payload.get('building_id')
-    print(f"🔍 Direct 'building_id' field: {building_id}")
+    if building_id:
+        return building_id
     
-    # Nếu không có trực tiếp, check các field khác
-    if not building_id:
-        # Check trong custom claims
-        custom_claims = token_payload.get('custom_claims', {})
-        if custom_claims:
-            building_id = custom_claims.get('building_id')
-            print(f"🔍 Found in custom_claims: {building_id}")
-        
-        # Check trong resource_access
-        if not building_id:
-            resource_access = token_payload.get('resource_access', {})
-            print(f"🔍 Checking resource_access: {resource_access}")
-        
-        # Check trong realm_access roles
-        if not building_id:
-            realm_access = token_payload.get('realm_access', {})
-            roles = realm_access.get('roles', []) if isinstance(realm_access, dict) else []
-            print(f"🔍 Checking realm_access roles: {roles}")
-            
-            # Có thể building_id là một role
-            for role in roles:
-                if 'building' in role.lower():
-                    building_id = role
-                    print(f"🔍 Found building_id in role: {building_id}")
-                    break
+    custom_claims = token_payload.get('custom_claims')
+    if isinstance(custom_claims, dict):
+        building_id = custom_claims.get('building_id')
+        if building_id:
+            return building_id
     
-    print(f"🏢 Final building_id: {building_id}")
-    return building_id
+    realm_access = token_payload.get('realm_access')
+    if isinstance(realm_access, dict):
+        for role in realm_access.get('roles') or ():
+            if 'building' in role.lower():
+                return role
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("No building_id in token payload keys: %s", list(token_payload))
+    return None
 
 
 def get_schema_from_building_id(building_id: str) -> str:
@@ -3,7 +3,10 @@
 APARTMENT CHATBOT - INTERACTIVE DEMO
 Test chatbot với đầy đủ chức năng: Service Fees, Amenities, Apartments, Floors
 """
-from gemini_bot import chatbot
+from gemini_bot import GeminiChatbot
+from schema.schema_context import set_current_schema
+import asyncio
+import os
 import sys
 import io
 
@@ -39,10 +42,15 @@ def print_separator():
     """In đường phân cách"""
     print("-" * 80)
 
-def main():
+async def main():
     """Main chatbot loop"""
     print_header()
 
+    # Demo chạy với schema của 1 toà nhà (như user đã đăng nhập), DB_SCHEMA trong .env
+    schema_name = os.getenv("DB_SCHEMA")
+    set_current_schema(schema_name)
+    chatbot = GeminiChatbot(schema_name=schema_name)
+
     conversation_count = 0
 
     while True:
@@ -72,7 +80,7 @@ def main():
 
         # Gọi chatbot
         try:
-            result = chatbot.chat(question)
+            result = await chatbot.achat(question)
 
             if result["success"]:
                 conversation_count += 1
@@ -108,7 +116,7 @@ def main():
 
 if __name__ == "__main__":
     try:
-        main()
+        asyncio.run(main())
     except KeyboardInterrupt:
         print("\n\n👋 Chương trình bị ngắt bởi người dùng. Tạm biệt!")
         sys.exit(0)
@@ -1,12 +1,161 @@
+import anyio
 import pyodbc
 import os
+import functools
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from typing import List, Dict, Any
+from typing import List, Any, Callable, Iterator, Optional, Tuple
 from schema.schema_context import get_current_schema
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Bật pooling của ODBC driver manager (phải set trước kết nối đầu tiên):
+# kết nối overflow bị đóng khi trả về pool vẫn được driver giữ lại để tái sử dụng
+pyodbc.pooling = True
+
+
+@functools.lru_cache(maxsize=256)
+def _render_query(query: str, schema: str) -> str:
+    """
+    Thay {schema} trong query template, cache theo (template, schema)
+
+    Schema không bind được như tham số (là identifier) nên được quote bằng [...]
+    để building_id lạ trong token không thể chèn SQL vào query
+    """
+    return query.replace('{schema}', '[' + schema.replace(']', ']]') + ']')
+
+
+class ConnectionPool:
+    """
+    Pool kết nối pyodbc dùng chung cho toàn bộ endpoints
+    
+    - Giữ tối đa pool_size kết nối idle để tái sử dụng
+    - Cho phép mở thêm max_overflow kết nối khi tải cao (đóng lại khi trả về)
+    - Kết nối cũ hơn recycle giây sẽ được đóng và tạo mới
+    - Kết nối idle lâu hơn ping_after giây được ping (SELECT 1) trước khi dùng
+    - prefill() mở sẵn kết nối lúc khởi động
+    """
+
+    def __init__(
+        self,
+        creator: Callable[[], pyodbc.Connection],
+        pool_size: int = 20,
+        max_overflow: int = 40,
+        recycle: int = 1800,
+        ping_after: int = 60,
+        timeout: float = 30.0
+    ):
+        self._creator = creator
+        self._recycle = recycle
+        self._ping_after = ping_after
+        self._timeout = timeout
+        # LIFO để các kết nối "nóng" được dùng lại trước
+        self._idle: "queue.LifoQueue[Tuple[pyodbc.Connection, float, float]]" = queue.LifoQueue(maxsize=pool_size)
+        # Giới hạn tổng số kết nối đang mở (idle + đang dùng)
+        self._slots = threading.BoundedSemaphore(pool_size + max_overflow)
+
+    def prefill(self, count: int) -> int:
+        """
+        Mở sẵn count kết nối idle (tối đa pool_size) để request đầu không phải chờ login
+
+        Returns:
+            Số kết nối đã mở được
+        """
+        opened = 0
+        for _ in range(min(count, self._idle.maxsize)):
+            try:
+                conn = self._creator()
+            except pyodbc.Error:
+                break
+            now = time.monotonic()
+            try:
+                self._idle.put_nowait((conn, now, now))
+            except queue.Full:
+                self._close(conn)
+                break
+            opened += 1
+        return opened
+
+    def _is_usable(self, conn: pyodbc.Connection, created_at: float, last_used: float) -> bool:
+        """Check kết nối idle còn dùng được không (recycle + pre-ping)"""
+        now = time.monotonic()
+        if now - created_at > self._recycle:
+            return False
+        if now - last_used > self._ping_after:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+            except pyodbc.Error:
+                return False
+        return True
+
+    def _checkout(self) -> Tuple[pyodbc.Connection, float]:
+        if not self._slots.acquire(timeout=self._timeout):
+            raise TimeoutError("Hết kết nối database trong pool, vui lòng thử lại sau")
+
+        try:
+            while True:
+                try:
+                    conn, created_at, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._creator(), time.monotonic()
+
+                if self._is_usable(conn, created_at, last_used):
+                    return conn, created_at
+                self._close(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _checkin(self, conn: pyodbc.Connection, created_at: float, discard: bool = False) -> None:
+        try:
+            if discard:
+                self._close(conn)
+                return
+            try:
+                self._idle.put_nowait((conn, created_at, time.monotonic()))
+            except queue.Full:
+                # Kết nối overflow → đóng luôn
+                self._close(conn)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _close(conn: pyodbc.Connection) -> None:
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+
+    @contextmanager
+    def connection(self) -> Iterator[pyodbc.Connection]:
+        """Mượn 1 kết nối từ pool, tự trả lại (hoặc bỏ đi nếu bị lỗi) khi xong"""
+        conn, created_at = self._checkout()
+        discard = False
+        try:
+            yield conn
+        except pyodbc.Error:
+            # Kết nối có thể đã hỏng, không trả lại pool
+            discard = True
+            raise
+        finally:
+            if not discard:
+                try:
+                    # Không để transaction dở dang cho lần mượn sau
+                    conn.rollback()
+                except pyodbc.Error:
+                    discard = True
+            self._checkin(conn, created_at, discard)
+
+
 class Database:
     def __init__(self):
         self.server = os.getenv('DB_SERVER')
@@ -21,14 +170,42 @@ class Database:
             f'PWD={self.password};'
             f'TrustServerCertificate=yes;'
         )
+        pool_size = int(os.getenv('DB_POOL_SIZE', '20'))
+        max_overflow = int(os.getenv('DB_POOL_MAX_OVERFLOW', '40'))
+        self.pool = ConnectionPool(
+            self.get_connection,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            recycle=int(os.getenv('DB_POOL_RECYCLE', '1800'))
+        )
+        self.pool.prefill(int(os.getenv('DB_POOL_PREFILL', '0')))
+        # Số thread chạy query cùng lúc từ code async = số kết nối tối đa của pool:
+        # request vượt quá chờ trên event loop thay vì chiếm thread rồi block trong _checkout
+        self._max_workers = pool_size + max_overflow
+        self._limiter: Optional[anyio.CapacityLimiter] = None
     
+    @property
+    def limiter(self) -> anyio.CapacityLimiter:
+        # Tạo lazy vì CapacityLimiter phải tạo trong event loop
+        if self._limiter is None:
+            self._limiter = anyio.CapacityLimiter(self._max_workers)
+        return self._limiter
+
+    async def run_sync(self, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        Chạy hàm blocking có query database (vd: handler của apartment_api) trong thread pool
+        
+        Giới hạn bởi self.limiter; ContextVar (schema) được copy sang thread
+        """
+        return await anyio.to_thread.run_sync(func, *args, limiter=self.limiter)
+
     def get_connection(self):
         """Tạo kết nối đến database"""
         try:
-            conn = pyodbc.connect(self.connection_string)
+            conn = pyodbc.connect(self.connection_string, autocommit=False)
             return conn
         except Exception as e:
-            print(f"❌ Lỗi kết nối database: {e}")
+            logger.error("Lỗi kết nối database: %s", e)
             raise
     
     def _inject_schema(self, query: str) -> str:
@@ -55,20 +232,63 @@ class Database:
             )
         
         # Replace {schema} placeholder với schema name
-        query = query.replace('{schema}', schema)
-        
-        return query
+        return _render_query(query, schema)
     
-    def execute_query(self, query: str, params: tuple = None) -> List[Dict[str, Any]]:
+    def execute_query(
+        self,
+        query: str,
+        params: tuple = None,
+        row_class: Optional[Callable[..., Any]] = None
+    ) -> List[Any]:
         """
         Thực thi SELECT query và trả về kết quả dạng list of dict
         
         Tự động inject schema vào query trước khi execute
+        
+        Nếu truyền row_class (ví dụ dataclass slots), mỗi row được build bằng
+        row_class(*row) theo đúng thứ tự cột SELECT thay vì dict
+        """
+        return list(self.iter_query(query, params, row_class=row_class))
+    
+    def iter_query(
+        self,
+        query: str,
+        params: tuple = None,
+        batch_size: int = 500,
+        row_class: Optional[Callable[..., Any]] = None
+    ) -> Iterator[Any]:
+        """
+        Thực thi SELECT query và trả về generator từng row (dict)
+        
+        Đọc cursor theo từng batch (fetchmany) thay vì fetchall, kết nối chỉ
+        được trả về pool khi generator chạy hết hoặc bị close
+        
+        Schema được inject ngay khi gọi (không đợi lúc iterate)
         """
         # Inject schema vào query
         query = self._inject_schema(query)
         
-        conn = self.get_connection()
+        return self._iter_rows(query, params, batch_size, row_class)
+    
+    def _iter_rows(
+        self,
+        query: str,
+        params: tuple,
+        batch_size: int,
+        row_class: Optional[Callable[..., Any]]
+    ) -> Iterator[Any]:
+        with self.pool.connection() as conn:
+            yield from self._iter_cursor(conn, query, params, batch_size, row_class)
+    
+    @staticmethod
+    def _iter_cursor(
+        conn: pyodbc.Connection,
+        query: str,
+        params: tuple,
+        batch_size: int,
+        row_class: Optional[Callable[..., Any]]
+    ) -> Iterator[Any]:
+        """Chạy 1 SELECT trên kết nối có sẵn, đọc cursor theo batch (fetchmany)"""
         cursor = conn.cursor()
         
         try:
@@ -80,18 +300,21 @@ class Database:
             # Lấy tên cột
             columns = [column[0] for column in cursor.description]
             
-            # Chuyển kết quả thành list of dict
-            results = []
-            for row in cursor.fetchall():
-                results.append(dict(zip(columns, row)))
-            
-            return results
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if row_class:
+                    for row in rows:
+                        yield row_class(*row)
+                else:
+                    for row in rows:
+                        yield dict(zip(columns, row))
         except Exception as e:
-            print(f"❌ Lỗi thực thi query: {e}")
+            logger.error("Lỗi thực thi query: %s", e)
             raise
         finally:
             cursor.close()
-            conn.close()
     
     def execute_non_query(self, query: str, params: tuple = None) -> int:
         """
@@ -102,24 +325,23 @@ class Database:
         # Inject schema vào query
         query = self._inject_schema(query)
         
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
             
-            conn.commit()
-            return cursor.rowcount
-        except Exception as e:
-            conn.rollback()
-            print(f"❌ Lỗi thực thi query: {e}")
-            raise
-        finally:
-            cursor.close()
-            conn.close()
+            try:
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                
+                conn.commit()
+                return cursor.rowcount
+            except Exception as e:
+                conn.rollback()
+                logger.error("Lỗi thực thi query: %s", e)
+                raise
+            finally:
+                cursor.close()
 
 # Singleton instance
 db = Database()
\ No newline at end of file
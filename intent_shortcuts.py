@@ -0,0 +1,117 @@
+"""
+Intent Shortcuts
+Nhận diện các câu hỏi dạng cố định (ví dụ: "thông tin căn 101") bằng regex để gọi thẳng API
+và trả lời theo template, không cần gọi Gemini
+
+Pattern phải khớp toàn bộ câu (đã chuẩn hóa) nên câu hỏi có thêm điều kiện / ngữ cảnh
+vẫn được chuyển cho Gemini xử lý
+"""
+import re
+import unicodedata
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Pattern, Tuple
+
+STATUS_LABELS = {
+    "AVAILABLE": "Còn trống",
+    "OCCUPIED": "Đã có người ở",
+    "RESERVED": "Đã đặt",
+    "MAINTENANCE": "Đang bảo trì",
+}
+
+
+class IntentMatch(NamedTuple):
+    """Kết quả khớp intent: function cần gọi (tên trong FUNCTION_MAP), args và hàm format câu trả lời"""
+    function_name: str
+    args: Dict[str, Any]
+    format: Callable[[Dict[str, Any]], str]
+
+
+def _format_number(value: Any) -> str:
+    """100000 → 100,000; 45.50 → 45.5"""
+    if value is None:
+        return "-"
+    number = float(value)
+    return f"{number:,.0f}" if number.is_integer() else f"{number:,.2f}".rstrip("0")
+
+
+def _format_apartment(result: Dict[str, Any]) -> str:
+    apartment = result["data"]
+    status = apartment.get("status")
+    lines = [
+        f"🏠 Căn hộ {apartment.get('apartment_number')}",
+        f"- Tầng: {apartment.get('floor_number')}"
+        + (f" ({apartment['floor_name']})" if apartment.get("floor_name") else ""),
+        f"- Diện tích: {_format_number(apartment.get('area_m2'))} m²",
+        f"- Số phòng ngủ: {apartment.get('bedrooms')}",
+        f"- Loại: {apartment.get('type') or '-'}",
+        f"- Trạng thái: {STATUS_LABELS.get(status, status or '-')}",
+    ]
+    return "\n".join(lines)
+
+
+def _format_floors(result: Dict[str, Any]) -> str:
+    floors = result["data"]
+    if not floors:
+        return "Hiện chưa có dữ liệu về các tầng trong toà nhà."
+    lines = [f"🏢 Toà nhà có {result['count']} tầng:"]
+    lines.extend(
+        f"- Tầng {floor['floor_number']}" + (f": {floor['name']}" if floor.get("name") else "")
+        for floor in floors
+    )
+    return "\n".join(lines)
+
+
+def _format_statistics(result: Dict[str, Any]) -> str:
+    stats = result["data"]
+    lines = [
+        f"📊 Tổng số căn hộ: {_format_number(stats['total_apartments'])}",
+        f"- {STATUS_LABELS['AVAILABLE']}: {_format_number(stats['available'])}",
+        f"- {STATUS_LABELS['OCCUPIED']}: {_format_number(stats['occupied'])}",
+        f"- {STATUS_LABELS['RESERVED']}: {_format_number(stats['reserved'])}",
+        f"- {STATUS_LABELS['MAINTENANCE']}: {_format_number(stats['maintenance'])}",
+        f"- Diện tích trung bình: {_format_number(stats['avg_area_m2'])} m² "
+        f"(từ {_format_number(stats['min_area_m2'])} đến {_format_number(stats['max_area_m2'])} m²)",
+    ]
+    return "\n".join(lines)
+
+
+_PREFIX = r"(?:cho (?:tôi|mình|em) )?(?:xem |biết |hỏi )?"
+
+# (pattern, function name, formatter) - compile 1 lần lúc import
+# Named group trong pattern = tên tham số của function
+INTENT_PATTERNS: List[Tuple[Pattern[str], str, Callable[[Dict[str, Any]], str]]] = [
+    (
+        re.compile(_PREFIX + r"(?:thông tin )?căn(?: hộ)?(?: số)? (?P<apartment_number>[a-z]?-?\d+[a-z]?)"),
+        "get_apartment_by_number",
+        _format_apartment,
+    ),
+    (
+        re.compile(_PREFIX + r"(?:danh sách (?:các )?tầng|các tầng|(?:t(?:oà|òa) nhà )?có (?:những|mấy|bao nhiêu) tầng(?: nào)?)"),
+        "get_floors",
+        _format_floors,
+    ),
+    (
+        re.compile(_PREFIX + r"(?:thống kê|tổng quan)(?: các)? căn hộ"),
+        "get_apartment_statistics",
+        _format_statistics,
+    ),
+]
+
+
+def match_intent(user_message: str) -> Optional[IntentMatch]:
+    """
+    Tìm intent khớp với toàn bộ câu hỏi
+
+    Returns:
+        IntentMatch hoặc None nếu không khớp (để Gemini xử lý)
+    """
+    # NFC: bàn phím tiếng Việt có thể gửi dấu dạng tổ hợp (NFD)
+    text = " ".join(unicodedata.normalize("NFC", user_message).lower().split()).rstrip("?.! ")
+    for pattern, function_name, formatter in INTENT_PATTERNS:
+        match = pattern.fullmatch(text)
+        if match is None:
+            continue
+        args = match.groupdict()
+        if "apartment_number" in args:
+            args["apartment_number"] = args["apartment_number"].upper()
+        return IntentMatch(function_name, args, formatter)
+    return None
@@ -8,19 +8,21 @@ from starlette.responses import Response
 from typing import Callable
 import logging
 
-from auth.jwt_handler import verify_keycloak_token, extract_building_id, get_schema_from_building_id
-from schema.schema_context import set_current_schema, clear_schema, get_current_schema
+from auth.jwt_handler import averify_keycloak_token, extract_building_id, get_schema_from_building_id
+from schema.schema_context import set_current_schema, reset_schema
 
 logger = logging.getLogger(__name__)
 
 # Public endpoints không cần authentication
-PUBLIC_ENDPOINTS = [
+PUBLIC_ENDPOINTS = frozenset({
     "/",
     "/health",
     "/docs",
     "/openapi.json",
     "/redoc"
-]
+})
+# Các đường dẫn con của docs (vd: /docs/oauth2-redirect)
+PUBLIC_PREFIXES = ("/docs", "/redoc")
 
 
 class JWTAuthMiddleware(BaseHTTPMiddleware):
@@ -38,27 +40,28 @@ class JWTAuthMiddleware(BaseHTTPMiddleware):
         5. Set schema vào context
         """
         # Skip authentication cho public endpoints
-        if request.url.path in PUBLIC_ENDPOINTS:
-            clear_schema()
+        path = request.url.path
+        if path in PUBLIC_ENDPOINTS or path.startswith(PUBLIC_PREFIXES):
             return await call_next(request)
         
+        schema_name = None
+        request.state.is_authenticated = False
+        request.state.schema_name = None
+        request.state.building_id = None
+        
         # Extract Authorization header
         auth_header = request.headers.get("Authorization")
         
         if not auth_header or not auth_header.startswith("Bearer "):
-            # Không có token → Set schema = None
+            # Không có token → schema = None
             logger.info("No Authorization header found, setting schema to None")
-            clear_schema()
-            request.state.is_authenticated = False
-            request.state.schema_name = None
-            request.state.building_id = None
         else:
             # Có token → Verify và extract
             token = auth_header.split(" ")[1]
             
             try:
-                # Verify token
-                payload = verify_keycloak_token(token)
+                # Verify token (token mới được verify trong thread pool)
+                payload = await averify_keycloak_token(token)
                 
                 # Extract building_id
                 building_id = extract_building_id(payload)
@@ -67,9 +70,6 @@ class JWTAuthMiddleware(BaseHTTPMiddleware):
                     # Map building_id → schema_name
                     schema_name = get_schema_from_building_id(building_id)
                     
-                    # Set vào context
-                    set_current_schema(schema_name)
-                    
                     # Store trong request state
                     request.state.is_authenticated = True
                     request.state.schema_name = schema_name
@@ -80,27 +80,17 @@ class JWTAuthMiddleware(BaseHTTPMiddleware):
                 else:
                     # Token không có building_id
                     logger.warning("Token does not contain building_id")
-                    clear_schema()
-                    request.state.is_authenticated = False
-                    request.state.schema_name = None
-                    request.state.building_id = None
                     
             except ValueError as e:
                 # Token invalid/expired
                 logger.warning(f"Token validation failed: {str(e)}")
-                clear_schema()
-                request.state.is_authenticated = False
-                request.state.schema_name = None
-                request.state.building_id = None
             except Exception as e:
                 # Unexpected error
                 logger.error(f"Unexpected error in auth middleware: {str(e)}")
-                clear_schema()
-                request.state.is_authenticated = False
-                request.state.schema_name = None
-                request.state.building_id = None
         
-        # Continue với request
-        response = await call_next(request)
-        return response
-
+        # Set schema vào context cho request này, luôn trả lại giá trị cũ khi xong
+        context_token = set_current_schema(schema_name)
+        try:
+            return await call_next(request)
+        finally:
+            reset_schema(context_token)
@@ -2,7 +2,7 @@
 Schema Context Manager
 Quản lý schema name trong request context sử dụng contextvars
 """
-from contextvars import ContextVar
+from contextvars import ContextVar, Token
 from typing import Optional
 
 # Context variable để lưu schema name
@@ -20,14 +20,21 @@ def get_current_schema() -> Optional[str]:
     """
     return _schema_context.get()
 
-def set_current_schema(schema: Optional[str]) -> None:
+def set_current_schema(schema: Optional[str]) -> Token:
     """
     Set schema name vào context
     
     Args:
         schema: Schema name hoặc None
+    
+    Returns:
+        Token để reset_schema() trả context về giá trị trước đó
     """
-    _schema_context.set(schema)
+    return _schema_context.set(schema)
+
+def reset_schema(token: Token) -> None:
+    """Trả schema về giá trị trước lần set_current_schema() tương ứng"""
+    _schema_context.reset(token)
 
 def has_schema() -> bool:
     """
@@ -0,0 +1,134 @@
+"""
+Redis Session Store
+Lưu metadata + lịch sử hội thoại của session trên Redis để nhiều worker/container dùng chung
+
+Mỗi session gồm 2 key (cùng TTL, gia hạn mỗi lần chat):
+- session:{sid}  JSON {"schema": ..., "last_activity": ..., "history_key": "history:{sid}"}
+- history:{sid}  list, mỗi phần tử là 1 lượt hội thoại (JSON array các Content)
+"""
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import orjson
+
+
+class RedisSessionStore:
+    """Session store trên Redis (redis.asyncio)"""
+
+    def __init__(self, url: str, ttl_seconds: int = 1800, max_turns: int = 20):
+        # Import tại đây để không bắt buộc cài redis khi chạy 1 worker
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.max_turns = max_turns
+
+    @staticmethod
+    def _session_key(session_id: str) -> str:
+        return f"session:{session_id}"
+
+    @staticmethod
+    def _history_key(session_id: str) -> str:
+        return f"history:{session_id}"
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Lấy metadata của session
+
+        Returns:
+            {"schema", "last_activity", "history_key"} hoặc None nếu không có / đã hết hạn
+        """
+        raw = await self._redis.get(self._session_key(session_id))
+        if raw is None:
+            return None
+        return orjson.loads(raw)
+
+    async def save(self, session_id: str, schema_name: Optional[str]) -> float:
+        """
+        Tạo/cập nhật metadata session và gia hạn TTL
+
+        Returns:
+            last_activity mới (dùng làm version để worker biết bản trong RAM còn đúng không)
+        """
+        meta = {
+            "schema": schema_name,
+            "last_activity": time.time(),
+            "history_key": self._history_key(session_id)
+        }
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(self._session_key(session_id), orjson.dumps(meta), ex=self.ttl_seconds)
+            pipe.expire(self._history_key(session_id), self.ttl_seconds)
+            await pipe.execute()
+        return meta["last_activity"]
+
+    async def append_turn(
+        self,
+        session_id: str,
+        schema_name: Optional[str],
+        contents: List[Dict[str, Any]]
+    ) -> float:
+        """
+        Lưu 1 lượt hội thoại (user message, function calls/responses, câu trả lời)
+
+        Chỉ giữ max_turns lượt gần nhất; cắt theo lượt để không tách
+        function_call khỏi function_response tương ứng
+
+        Returns:
+            last_activity mới
+        """
+        history_key = self._history_key(session_id)
+        meta = {
+            "schema": schema_name,
+            "last_activity": time.time(),
+            "history_key": history_key
+        }
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(history_key, orjson.dumps(contents))
+            pipe.ltrim(history_key, -self.max_turns, -1)
+            pipe.expire(history_key, self.ttl_seconds)
+            pipe.set(self._session_key(session_id), orjson.dumps(meta), ex=self.ttl_seconds)
+            await pipe.execute()
+        return meta["last_activity"]
+
+    async def load_history(self, session_id: str) -> List[Dict[str, Any]]:
+        """Lấy toàn bộ lịch sử (đã nối các lượt) theo thứ tự thời gian"""
+        turns = await self._redis.lrange(self._history_key(session_id), 0, -1)
+        return [content for turn in turns for content in orjson.loads(turn)]
+
+    async def clear_history(self, session_id: str) -> None:
+        """Xóa lịch sử nhưng giữ session"""
+        await self._redis.delete(self._history_key(session_id))
+
+    async def delete(self, session_id: str) -> bool:
+        """
+        Xóa session
+
+        Returns:
+            True nếu session tồn tại
+        """
+        deleted = await self._redis.delete(
+            self._session_key(session_id),
+            self._history_key(session_id)
+        )
+        return deleted > 0
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+def create_session_store() -> Optional[RedisSessionStore]:
+    """
+    Tạo Redis session store nếu có REDIS_URL
+
+    Returns:
+        RedisSessionStore hoặc None (chỉ dùng session trong RAM của worker)
+    """
+    url = os.getenv("REDIS_URL")
+    if not url:
+        return None
+    return RedisSessionStore(
+        url,
+        ttl_seconds=int(os.getenv("SESSION_TTL_SECONDS", "1800")),
+        max_turns=int(os.getenv("SESSION_HISTORY_TURNS", "20"))
+    )
@@ -0,0 +1,103 @@
+"""
+Session Cache
+Lưu chat sessions trong RAM có giới hạn: LRU theo số lượng + TTL theo thời gian không hoạt động
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Iterator, Optional, Tuple
+
+# Value của mỗi session: (GeminiChatbot instance, schema_name)
+SessionEntry = Tuple[Any, Optional[str]]
+
+
+class SessionCache:
+    """
+    LRU cache cho chat sessions
+
+    - Quá capacity: bỏ session lâu không dùng nhất
+    - Không hoạt động quá ttl_seconds: session hết hạn (bị xóa khi get hoặc khi sweep)
+
+    Chỉ được truy cập từ event loop nên không cần lock
+    """
+
+    def __init__(self, capacity: int = 1000, ttl_seconds: float = 1800):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        # session_id -> (chatbot, schema_name, last_activity)
+        self._sessions: "OrderedDict[str, Tuple[Any, Optional[str], float]]" = OrderedDict()
+
+    def get(self, session_id: str) -> Optional[SessionEntry]:
+        """
+        Lấy session và cập nhật last_activity
+
+        Returns:
+            (chatbot, schema_name) hoặc None nếu không có / đã hết hạn
+        """
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+
+        chatbot, schema_name, last_activity = entry
+        now = time.monotonic()
+        if now - last_activity > self.ttl_seconds:
+            del self._sessions[session_id]
+            return None
+
+        self._sessions[session_id] = (chatbot, schema_name, now)
+        self._sessions.move_to_end(session_id)
+        return chatbot, schema_name
+
+    def put(self, session_id: str, chatbot: Any, schema_name: Optional[str]) -> None:
+        """Thêm/cập nhật session, bỏ session cũ nhất nếu vượt capacity"""
+        self._sessions[session_id] = (chatbot, schema_name, time.monotonic())
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.capacity:
+            self._sessions.popitem(last=False)
+
+    def pop(self, session_id: str) -> Optional[SessionEntry]:
+        """
+        Xóa session
+
+        Returns:
+            (chatbot, schema_name) đã xóa hoặc None nếu không có
+        """
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return None
+        return entry[0], entry[1]
+
+    def sweep(self) -> int:
+        """
+        Xóa tất cả session hết hạn
+
+        Returns:
+            Số session đã xóa
+        """
+        deadline = time.monotonic() - self.ttl_seconds
+        # Thứ tự LRU: session cũ nhất ở đầu, gặp session còn hạn là dừng
+        expired = 0
+        while self._sessions:
+            session_id, (_, _, last_activity) = next(iter(self._sessions.items()))
+            if last_activity >= deadline:
+                break
+            del self._sessions[session_id]
+            expired += 1
+        return expired
+
+    def items(self) -> Iterator[Tuple[str, SessionEntry]]:
+        """
+        Duyệt (session_id, (chatbot, schema_name)) của các session hiện có (cũ nhất trước)
+
+        Duyệt trực tiếp trên cache, không copy: không được get/put/pop trong lúc duyệt
+        """
+        for session_id, (chatbot, schema_name, _) in self._sessions.items():
+            yield session_id, (chatbot, schema_name)
+
+    def keys(self) -> Iterator[str]:
+        return iter(self._sessions)
+
+    def __contains__(self, session_id: object) -> bool:
+        return session_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
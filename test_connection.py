@@ -1,29 +1,36 @@
+import os
+import sys
+
 from database import db
+from schema.schema_context import set_current_schema
 
-def test_database_connection():
-    """Test kết nối database"""
+def test_database_connection(schema_name: str = "dbo"):
+    """Test kết nối database, liệt kê các bảng của schema"""
     try:
         print("🔄 Đang kết nối đến database...")
-        
-        # Test query đơn giản
+
+        # db chỉ chạy query khi có schema trong context
+        set_current_schema(schema_name)
+
+        # Test query đơn giản (chỉ các bảng của schema cần kiểm tra)
         query = """
-        SELECT TABLE_NAME 
-        FROM INFORMATION_SCHEMA.TABLES 
-        WHERE TABLE_TYPE = 'BASE TABLE'
+        SELECT TABLE_NAME
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_TYPE = 'BASE TABLE' AND TABLE_SCHEMA = ?
         ORDER BY TABLE_NAME
         """
-        
-        results = db.execute_query(query)
-        
+
+        # Đọc dần từng batch thay vì fetchall, in 1 lần
+        tables = [row['TABLE_NAME'] for row in db.iter_query(query, (schema_name,))]
+
         print("✅ Kết nối thành công!")
-        print(f"\n📊 Database có {len(results)} bảng:")
-        for row in results:
-            print(f"   - {row['TABLE_NAME']}")
-        
+        listing = "\n".join(f"   - {table}" for table in tables)
+        print(f"\n📊 Schema {schema_name} có {len(tables)} bảng:\n{listing}")
+
         return True
     except Exception as e:
         print(f"❌ Lỗi: {e}")
         return False
 
 if __name__ == "__main__":
-    test_database_connection()
\ No newline at end of file
+    test_database_connection(sys.argv[1] if len(sys.argv) > 1 else os.getenv("DB_SCHEMA", "dbo"))